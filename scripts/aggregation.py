@@ -0,0 +1,1568 @@
+'''
+Spec-driven aggregation engine shared by every experiment's analysis/aggregate.py.
+
+Each experiment describes what to aggregate with a spec (a dictionary):
+- run_cfg_fields_summary: run configuration fields to keep in summary output file(s)
+- run_cfg_fields_time_series: run configuration fields to keep in time series output file
+- output_files: list of run output files to aggregate, in order. Each entry is a dictionary:
+  - file: file name (inside each run's output directory)
+  - prefix: prefix given to this file's fields in the summary/time series output files
+  - summary_fields: which fields to keep in the summary file (optional; all non-update fields if missing)
+  - time_series_fields: which fields to keep in the time series file (optional; none if missing)
+  - interaction_values: if True, this file's full summary line is also written to
+    symbiont_interaction_values.csv (optional)
+  - population_events: maps a population label to one of this file's count fields, e.g.,
+    {"host": "host_count", "sym": "hosted_sym_count"} (optional). For each, extinction/collapse
+    events are extracted from the file at full resolution (up to the summary update) and added
+    to the summary file (see update_population_events). Not computed with --summary_only.
+  - task_acquisition_fields: task count fields (e.g., NOT_in_host_parent_org_counts) to compute
+    task acquisition metrics for (optional; see update_task_acquisition). Not computed with
+    --summary_only.
+  The first output file determines which updates a run recorded (i.e., OrganismCounts.csv).
+
+This script generates the following output files:
+- aggregation_done: written last, once every other output file is complete
+- run_status.csv: one line per run directory found (status, last recorded update, output file sizes;
+  see discovery.py)
+- summary.csv: one line per-replicate
+- symbiont_interaction_values.csv: one line per-replicate (only if spec has an interaction values file)
+- time_series.csv: one line per-replicate per sampled update
+  Before aggregating, the header of every run's output files is scanned (in parallel) and schema
+  variants are reported. The header of every output file (time series, summary, interaction
+  values, task acquisition) is the union of every run's fields; fields a run is missing are
+  written as "NA".
+  With --partition_time_series, time series output is instead split by condition (RUN_C{i} prefix):
+  - time_series/C{i}.csv: time series for a single condition
+  - time_series/conditions.csv: maps condition IDs to parameter values (and their time series file,
+    and how many replicates have rows in it; conditions without any have no time series file)
+- time_series_r{resolution}.csv: with --time_series_pyramid, one additional time series file per
+  listed resolution (e.g., 100,500,5000), all extracted in the same pass over each run's files
+With --rollup, per-condition time series statistics are also written:
+- time_series_rollup.csv: one line per-condition per sampled update; for each time series field,
+  the mean, standard deviation, standard error, and bootstrap 95% confidence interval of the mean
+  across replicates
+If spec has task acquisition fields (and not --summary_only):
+- task_acquisition.csv: one line per-replicate; first update each task count crossed the
+  threshold (--task_threshold * max_pop_size), updates spent at/above it, and whether it ever did
+- task_acquisition_long.csv: one line per-replicate per task (same metrics)
+With --interaction_histograms, every run's full interaction value histogram trajectory (Hist_* fields
+of the spec's interaction values file, at every recorded update) is also written:
+- interaction_value_histograms.npy: (total updates recorded across runs x bins) int64 array; each run's
+  trajectory is a contiguous block of rows (open with numpy.load(..., mmap_mode="r"))
+- interaction_value_histograms_updates.npy: update of each row
+- interaction_value_histograms_index.csv: one line per-replicate, with the run's [start, stop) rows
+- interaction_value_histograms_bins.csv: bin (column) index -> histogram field
+With --max_memory, run output files are read in chunks of rows sized to the given budget (instead
+of whole files), time series are extracted with a streaming join (--streaming_join) one row at a
+time, and each run's time series rows are spilled to a file (time_series_spill/, or fragments/ with
+--incremental) that is then copied into the time series output files. Updates are kept as arrays
+(8 bytes per recorded update), so memory use depends on the number of fields rather than on the
+number of sampled updates or runs (the cube, rollup, and interaction histograms are not covered).
+Peak memory use is reported at the end of aggregation.
+With --cube, every run's numeric output columns are also packed into an experiment data cube
+(runs x sampled updates x fields; see cube.py) in cube/. Like the time series output, the cube
+only has runs that reached the summary update.
+With --prefetch_runs K (serial aggregation), the files of the next K runs are read in background
+threads (up to --prefetch_memory MB) while the current run is parsed.
+With --shard I --num_shards N, only the I-th of N contiguous blocks of run directories is
+aggregated (e.g., one task of a SLURM array job); see sharding.py for generating array jobs and
+merging shard output files. With --run_list, run directories are read from a csv file
+(see discovery.write_run_list) instead of being discovered, so that every shard splits up the
+same list of runs.
+Run directories may also be stored as archives (RUN_*.tar, .tar.gz, .tgz, .zip) and output files
+may be gzipped (*.csv.gz); see archives.py.
+Optionally, each output file is also written in a typed, columnar format (--columnar_format):
+- feather (Arrow IPC; in R, arrow::read_feather) or parquet (in R, arrow::read_parquet)
+'''
+
+import argparse
+import functools
+import json
+import os
+import re
+import resource
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import archives
+import cube
+import discovery
+import utilities as utils
+
+# Written to dump_dir as the last step of aggregation (e.g., so that sharding.py can tell
+# finished shards from map tasks that died partway through)
+done_marker = "aggregation_done"
+
+# Run directories are named RUN_C{condition id}_{SEED} (see gen-slurm.py)
+run_condition_regex = re.compile(r"RUN_(C\d+)_")
+
+# Approximate memory used per (parsed) value while reading run output files in chunks
+# (see iter_run_columns), and the fewest rows read in a chunk.
+chunk_value_bytes = 128
+min_chunk_rows = 64
+
+# Interaction value histogram fields are named Hist_{bin lower bound} (see SymbiontInteractionValues.csv)
+histogram_field_prefix = "Hist_"
+
+# Task count fields are named {task}_in_{host/sym}_parent_org_counts (see CurrentUpdateInfo.csv)
+task_field_regex = re.compile(r"(.+)_in_(host|sym)_parent_org_counts$")
+
+def extract_summary_data(summary_line, fields=None, prefix=None):
+        '''
+        Pull specified fields (all non-update fields if None) out of a run's summary
+        data line (see utils.read_csv_row).
+        '''
+        info = {}
+
+        # No data line matched the target update for this run
+        if summary_line is None:
+            return info
+
+        # Add specified fields to run summary data
+        for field in summary_line:
+            if (fields is None) and (field == "update"):
+                continue
+            if (fields is None) or (field in fields):
+                if prefix is None:
+                    info[field] = summary_line[field]
+                else:
+                    info[f"{prefix}_{field}"] = summary_line[field]
+
+        return info
+
+def read_summary_line(file_path, target_update, from_tail=False, cache_dir=None):
+    '''
+    Grab the data line for the target update from a run output file.
+    If from_tail, first try reading backwards from the end of the file, falling back
+    to a lookup via the file's update index (built with a forward scan).
+    '''
+    summary_line = utils.read_csv_row_from_tail(file_path, target_update) if from_tail else None
+    if summary_line is None:
+        summary_line = utils.read_csv_row(file_path, target_update, cache_dir=cache_dir)
+    return summary_line
+
+def read_run_columns(file_path, fields, cache=False, cache_dir=None, dtypes=None, update_rows=None):
+    '''
+    Load the given columns from a run output file, optionally through the binary
+    column cache (see utils.read_csv_columns_cached). update_rows optionally collects the
+    full rows of given updates in the same read (see utils.read_csv_columns).
+    '''
+    if cache:
+        return utils.read_csv_columns_cached(file_path, fields = fields, dtypes = dtypes, cache_dir = cache_dir, update_rows = update_rows)
+    return utils.read_csv_columns(file_path, fields = fields, dtypes = dtypes, update_rows = update_rows)
+
+def iter_run_columns(file_path, fields, cache=False, cache_dir=None, memory_budget=None, dtypes=None):
+    '''
+    Yield the given columns from a run output file in chunks of rows (in file order).
+    Without a memory budget (in bytes), the whole file is a single chunk (see read_run_columns).
+    Otherwise, chunks are sized to fit in the budget (so memory use depends on the number of
+    fields, not on the number of rows) and the column cache is not used.
+    '''
+    if memory_budget is None:
+        yield read_run_columns(file_path, fields, cache = cache, cache_dir = cache_dir, dtypes = dtypes)
+        return
+    chunk_size = max(min_chunk_rows, memory_budget // (chunk_value_bytes * len(fields)))
+    yield from utils.iter_csv_column_chunks(file_path, fields = fields, chunk_size = chunk_size, dtypes = dtypes)
+
+def numeric_column(values):
+    '''
+    Numeric version of a column that was loaded as text (time series fields are loaded as
+    text so that values are written out as they appear in run output files).
+    '''
+    return utils.typed_array(values) if values.dtype.kind == "U" else values
+
+def add_time_series_info(
+    time_series_data,
+    run_data,
+    fields,
+    prefix = None
+):
+    # Find rows in run data for updates we want to sample
+    updates = run_data["update"]
+    rows = np.flatnonzero(np.isin(updates, list(time_series_data.keys())))
+    row_updates = updates[rows].tolist()
+    # For each relevant field in run data, add sampled values to time_series_data
+    for field in run_data:
+        if not field in fields:
+            continue
+        name = field if prefix is None else f"{prefix}_{field}"
+        for line_update, value in zip(row_updates, run_data[field][rows].tolist()):
+            time_series_data[line_update][name] = value
+
+def fraction_label(fraction):
+    '''
+    Label for a fraction of max population size used in summary field names (0.1 => "10pct").
+    '''
+    return f"{fraction * 100:g}pct"
+
+def update_population_events(
+    state,
+    run_data,
+    events,
+    max_pop_size,
+    fractions,
+    last_update
+):
+    '''
+    Update extinction/collapse events for each population count field (see spec population_events)
+    with a chunk of run data (rows in update order). Only updates <= last_update are considered.
+    Count fields missing from the run's file are skipped (their events come out as "NA").
+    state (a dictionary; start empty) carries events across chunks, see population_events_info.
+    '''
+    updates = run_data["update"]
+    keep = updates <= last_update
+    updates = updates[keep]
+    if len(updates) == 0:
+        return
+    for label, field in events.items():
+        if not field in run_data:
+            continue
+        counts = numeric_column(run_data[field])[keep]
+        label_state = state.setdefault(label, {
+            "extinct_update": "NA",
+            "min_count": None,
+            "min_count_update": None,
+            "below_update": {fraction: "NA" for fraction in fractions}
+        })
+        extinct = np.flatnonzero(counts == 0)
+        if len(extinct) and label_state["extinct_update"] == "NA":
+            label_state["extinct_update"] = updates[extinct[0]].item()
+        min_i = np.argmin(counts)
+        if (label_state["min_count"] is None) or (counts[min_i].item() < label_state["min_count"]):
+            label_state["min_count"] = counts[min_i].item()
+            label_state["min_count_update"] = updates[min_i].item()
+        for fraction in fractions:
+            below = np.flatnonzero(counts < fraction * max_pop_size)
+            if len(below) and label_state["below_update"][fraction] == "NA":
+                label_state["below_update"][fraction] = updates[below[0]].item()
+
+def population_events_info(state, fractions, prefix = None):
+    '''
+    Summary fields for extinction/collapse events accumulated by update_population_events.
+    For each population label:
+    - {label}_extinct_update: first update where count hit 0
+    - {label}_min_count: minimum count
+    - {label}_min_count_update: (first) update where minimum count was recorded
+    - {label}_below_{fraction}_update: first update where count fell below fraction * max_pop_size
+    Events that never happened are "NA".
+    '''
+    info = {}
+    for label, label_state in state.items():
+        name = label if prefix is None else f"{prefix}_{label}"
+        info[f"{name}_extinct_update"] = label_state["extinct_update"]
+        info[f"{name}_min_count"] = label_state["min_count"]
+        info[f"{name}_min_count_update"] = label_state["min_count_update"]
+        for fraction in fractions:
+            info[f"{name}_below_{fraction_label(fraction)}_update"] = label_state["below_update"][fraction]
+    return info
+
+def task_field_labels(field):
+    '''
+    Split a task count field (e.g., "OR_NOT_in_sym_parent_org_counts") into its task
+    ("OR_NOT") and organism ("sym"). Fields that do not follow this pattern are their own task.
+    '''
+    match = task_field_regex.match(field)
+    if match is None:
+        return field, "NA"
+    return match.group(1), match.group(2)
+
+def update_task_acquisition(state, run_data, fields, threshold, last_update):
+    '''
+    Update task acquisition metrics for each task count field with a chunk of run data (rows
+    in update order). Only updates <= last_update are considered. A task counts as completed at
+    an update if its count is >= threshold. Each recorded update covers the interval until the
+    next recorded update (the last one covers the preceding interval), so the last row of a chunk
+    is held as pending until the next chunk (or task_acquisition_rows) settles it.
+    state (a dictionary; start empty) carries metrics across chunks.
+    '''
+    updates = run_data["update"]
+    keep = updates <= last_update
+    updates = updates[keep]
+    if len(updates) == 0:
+        return
+    durations = np.diff(updates)
+    for field in fields:
+        if not field in run_data:
+            continue
+        above = numeric_column(run_data[field])[keep] >= threshold
+        field_state = state.setdefault(field, {
+            "first_update": "NA",
+            "updates_above": 0,
+            "pending": None,
+            "interval": 0
+        })
+        # Settle pending row from previous chunk
+        if field_state["pending"] is not None:
+            pending_update, pending_above = field_state["pending"]
+            field_state["interval"] = updates[0].item() - pending_update
+            if pending_above:
+                field_state["updates_above"] += field_state["interval"]
+        field_state["updates_above"] += durations[above[:-1]].sum().item()
+        if len(durations):
+            field_state["interval"] = durations[-1].item()
+        field_state["pending"] = (updates[-1].item(), bool(above[-1]))
+        crossed = np.flatnonzero(above)
+        if len(crossed) and field_state["first_update"] == "NA":
+            field_state["first_update"] = updates[crossed[0]].item()
+
+def task_acquisition_rows(state):
+    '''
+    Task acquisition metrics accumulated by update_task_acquisition, one row per field:
+    - first_update: first update at/above threshold ("NA" if never)
+    - updates_above: updates spent at/above threshold
+    - ever_completed: whether the task was ever at/above threshold
+    '''
+    rows = []
+    for field in sorted(state.keys()):
+        field_state = state[field]
+        updates_above = field_state["updates_above"]
+        if (field_state["pending"] is not None) and field_state["pending"][1]:
+            updates_above += field_state["interval"]
+        task, organism = task_field_labels(field)
+        rows.append({
+            "task": task,
+            "organism": organism,
+            "first_update": field_state["first_update"],
+            "updates_above": updates_above,
+            "ever_completed": field_state["first_update"] != "NA"
+        })
+    return rows
+
+def task_acquisition_row(summary_info, spec, task_rows):
+    '''
+    Wide (one line per-replicate) version of a run's task acquisition rows.
+    '''
+    row = {
+        field: summary_info[field]
+        for field in summary_info
+        if (field in spec["run_cfg_fields_summary"]) or (field in {"max_pop_size", "update"})
+    }
+    for task_row in task_rows:
+        label = f"{task_row['task']}_{task_row['organism']}"
+        for metric in ["first_update", "updates_above", "ever_completed"]:
+            row[f"{label}_{metric}"] = task_row[metric]
+    return row
+
+def has_task_acquisition(spec):
+    '''
+    Does this spec write out task acquisition files?
+    '''
+    return any(
+        len(output_file.get("task_acquisition_fields", set()))
+        for output_file in spec["output_files"]
+    )
+
+def interaction_values_file(spec):
+    '''
+    The spec's interaction values output file entry (None if it has none).
+    '''
+    for output_file in spec["output_files"]:
+        if output_file.get("interaction_values", False):
+            return output_file
+    return None
+
+def write_interaction_histograms(
+    dump_dir,
+    data_dir,
+    runs,
+    spec,
+    cache = False,
+    cache_dir = None,
+    memory_budget = None
+):
+    '''
+    Write every run's full interaction value histogram trajectory into a single
+    memory-mappable array (see module docstring for the files written).
+    runs is a list of (run_dir, index info) pairs, in output order.
+    Runs are stacked along the update axis: row counts come from each file's update
+    index, so the output array is allocated up front and filled one run at a time.
+    Bins are the union of every run's Hist_* fields (in bin order); bins a run's file
+    lacks are filled with 0 (with a warning).
+    '''
+    file_name = interaction_values_file(spec)["file"]
+    file_paths = [os.path.join(data_dir, run_dir, "output", file_name) for run_dir, _ in runs]
+    # Runs missing their interaction values file get an empty block
+    row_counts = [
+        len(utils.load_update_index(file_path, cache_dir = cache_dir)["updates"])
+        if archives.exists(file_path) else 0
+        for file_path in file_paths
+    ]
+    run_bin_fields = [
+        [field for field in (utils.read_csv_header(file_path) or []) if field.startswith(histogram_field_prefix)]
+        if row_count else []
+        for file_path, row_count in zip(file_paths, row_counts)
+    ]
+    bin_fields = list(dict.fromkeys(field for fields in run_bin_fields for field in fields))
+    try:
+        bin_fields.sort(key = lambda field: float(field[len(histogram_field_prefix):]))
+    except ValueError:
+        pass # Bins not named by their lower bound; keep order of first appearance
+
+    histograms_path = os.path.join(dump_dir, "interaction_value_histograms.npy")
+    updates_path = os.path.join(dump_dir, "interaction_value_histograms_updates.npy")
+    total_rows = sum(row_counts)
+    histograms = np.lib.format.open_memmap(
+        histograms_path,
+        mode = "w+",
+        dtype = np.int64,
+        shape = (total_rows, len(bin_fields))
+    )
+    updates = np.lib.format.open_memmap(updates_path, mode = "w+", dtype = np.int64, shape = (total_rows,))
+
+    index_rows = []
+    start = 0
+    for (run_dir, info), file_path, row_count, fields in zip(runs, file_paths, row_counts, run_bin_fields):
+        stop = start + row_count
+        row = start
+        missing_bins = [field for field in bin_fields if not field in fields]
+        if row_count and len(missing_bins):
+            print(f"Warning: {run_dir} is missing interaction value histogram bins {', '.join(missing_bins)}; filling them in with 0")
+        run_data_chunks = iter_run_columns(
+            file_path,
+            fields = set(fields) | {"update"},
+            cache = cache,
+            cache_dir = cache_dir,
+            memory_budget = memory_budget
+        ) if row_count else []
+        for run_data in run_data_chunks:
+            chunk_rows = min(len(run_data["update"]), stop - row)
+            updates[row:row + chunk_rows] = run_data["update"][:chunk_rows]
+            for bin_i, field in enumerate(bin_fields):
+                histograms[row:row + chunk_rows, bin_i] = run_data[field][:chunk_rows] if field in run_data else 0
+            row += chunk_rows
+            del run_data
+        index_row = {"run_dir": run_dir, "start": start, "stop": stop}
+        index_row.update(info)
+        index_rows.append(index_row)
+        start = stop
+    histograms.flush()
+    updates.flush()
+    del histograms, updates
+
+    with utils.CSVWriter(os.path.join(dump_dir, "interaction_value_histograms_index.csv"), union_header = True, sort_header = False) as writer:
+        writer.write_rows(index_rows)
+    utils.write_csv(
+        os.path.join(dump_dir, "interaction_value_histograms_bins.csv"),
+        [{"bin": bin_i, "field": field} for bin_i, field in enumerate(bin_fields)]
+    )
+
+def iter_time_series_rows(
+    sampled_updates,
+    file_paths,
+    output_files,
+    base_row,
+    header
+):
+    '''
+    Yield a run's time series rows for the given sampled updates (sorted array), pulling fields
+    from several run output files at once via a streaming merge-join of the files on update
+    (see utils.iter_csv_merged). Each row starts from base_row (run config fields) and only
+    has fields in header. Fields from a file missing a sampled update (or missing altogether)
+    are "NA". Values are kept as written in the output files. Only a single row (plus one row
+    per file) is held in memory at a time.
+    '''
+    header = set(header)
+    fields = []
+    names = []
+    for output_file in output_files:
+        prefix = output_file["prefix"]
+        file_fields = [
+            field for field in sorted(output_file["time_series_fields"])
+            if (field if prefix is None else f"{prefix}_{field}") in header
+        ]
+        fields.append(file_fields)
+        names.append([field if prefix is None else f"{prefix}_{field}" for field in file_fields])
+    present = [file_i for file_i, file_path in enumerate(file_paths) if archives.exists(file_path)]
+    merged = utils.iter_csv_merged(
+        [file_paths[file_i] for file_i in present],
+        fields = [fields[file_i] for file_i in present]
+    )
+    merged_update, merged_rows = next(merged, (None, None))
+    for update in sampled_updates:
+        update = int(update)
+        row = dict(base_row, update = update)
+        for file_names in names:
+            row.update({name: "NA" for name in file_names})
+        # Skip past updates that were not sampled
+        while (merged_update is not None) and (merged_update < update):
+            merged_update, merged_rows = next(merged, (None, None))
+        if merged_update == update:
+            for file_i, file_row in zip(present, merged_rows):
+                if file_row is None:
+                    continue
+                for field, name in zip(fields[file_i], names[file_i]):
+                    if field in file_row:
+                        row[name] = file_row[field]
+        yield row
+
+def spill_path(spill_dir, run_dir, name):
+    '''
+    Location of a run's (time series) spill file (see aggregate_run).
+    '''
+    return os.path.join(spill_dir, f"{run_dir.replace(os.sep, '__')}.{name}.csv")
+
+def has_interaction_values(spec):
+    '''
+    Does this spec write out a symbiont interaction values file?
+    '''
+    return interaction_values_file(spec) is not None
+
+def time_series_data_fields(spec):
+    '''
+    Names (prefixed, as written to time series output) of time series fields pulled from
+    run output files (i.e., excludes run config fields and update).
+    '''
+    fields = []
+    for output_file in spec["output_files"]:
+        prefix = output_file["prefix"]
+        for field in sorted(output_file.get("time_series_fields", set())):
+            fields.append(field if prefix is None else f"{prefix}_{field}")
+    return fields
+
+def add_rollup_run(rollup_data, condition, time_series_rows, fields):
+    '''
+    Stash one run's time series values (as arrays) for its condition's rollup.
+    Non-numeric fields are skipped.
+    '''
+    condition_data = rollup_data.setdefault(condition, {"runs": [], "params": {}})
+    if not condition_data["params"]:
+        condition_data["params"] = {
+            field: time_series_rows[0][field] for field in sorted(time_series_rows[0].keys())
+            if (not field in fields) and (field not in {"update", "SEED"})
+        }
+    run_values = {"update": np.array([row["update"] for row in time_series_rows], dtype=np.int64)}
+    for field in fields:
+        try:
+            run_values[field] = np.array([row[field] for row in time_series_rows], dtype=np.float64)
+        except (KeyError, TypeError, ValueError):
+            continue
+    condition_data["runs"].append(run_values)
+
+def iter_rollup_rows(rollup_data, fields, bootstrap_samples=1000):
+    '''
+    Reduce stashed run time series (see add_rollup_run) to per-condition, per-update
+    statistics. Replicates are stacked into (replicates x updates) arrays per field (NaN
+    where a replicate did not record an update) and summarized column-wise.
+    Yields one output row per condition per update.
+    '''
+    rng = np.random.default_rng(0)
+    conditions = sorted(rollup_data.keys(), key = lambda c: (len(c), c))
+    for condition in conditions:
+        runs = rollup_data[condition]["runs"]
+        updates = np.unique(np.concatenate([run["update"] for run in runs]))
+        stats = {}
+        for field in fields:
+            stacked = np.full((len(runs), len(updates)), np.nan)
+            for run_i, run in enumerate(runs):
+                if field in run:
+                    stacked[run_i, np.searchsorted(updates, run["update"])] = run[field]
+            stats[field] = utils.replicate_stats(stacked, bootstrap_samples, rng = rng)
+        for update_i, update in enumerate(updates.tolist()):
+            row = {"condition": condition, "update": update}
+            row.update(rollup_data[condition]["params"])
+            for field in fields:
+                field_stats = stats[field]
+                row[f"{field}_n"] = int(field_stats["n"][update_i])
+                for stat in ["mean", "sd", "se", "ci_low", "ci_high"]:
+                    value = field_stats[stat][update_i]
+                    row[f"{field}_{stat}"] = "NA" if np.isnan(value) else value.item()
+            yield row
+
+def run_condition(run_dir):
+    '''
+    Condition ID (e.g., "C3") of a run directory. Runs whose directory name does not
+    carry a condition ID are grouped into a single "C" condition.
+    '''
+    match = run_condition_regex.match(os.path.basename(run_dir))
+    return match.group(1) if match else "C"
+
+def aggregate_run(run_dir, data_dir, spec, settings):
+    '''
+    Extract summary, interaction value, and time series data for a single run directory.
+    Returns a dictionary of this run's output fragments:
+    - status: "ok", "incomplete" (no run_config.csv), or "empty" (no updates recorded)
+    - summary: summary file row
+    - sym_int_vals: symbiont interaction values file row
+    - time_series: time series file rows (in update order)
+    - time_series_levels: time series rows for each time series pyramid resolution (in order of
+      settings["time_series_levels"]); rows are shared with time_series where updates overlap
+    - time_series_spill: if settings["spill_dir"] is given, time series rows are written to files
+      there instead (time series file, then one per pyramid level; headerless, with
+      settings["time_series_header"] fields) and this lists those files (None otherwise)
+    - time_series_spill_header: header the time series spill files were written with (None if
+      not spilling); stored spill files are re-mapped onto the current header when reused
+    - task_acquisition: task acquisition rows (one per task)
+    '''
+    target_update = settings["target_update"]
+    time_series_units = settings["time_series_units"]
+    time_series_resolution = settings["time_series_resolution"]
+    time_series_levels = settings["time_series_levels"]
+    summary_only = settings["summary_only"]
+    streaming_join = settings["streaming_join"]
+    cache = settings["cache"]
+    cache_dir = settings["cache_dir"]
+    memory_budget = settings["memory_budget"]
+    collapse_fractions = settings["collapse_fractions"]
+    task_threshold = settings["task_threshold"]
+
+    run_path = os.path.join(data_dir, run_dir)
+    run_fragments = {
+        "run_dir": run_dir,
+        "status": "ok",
+        "summary": None,
+        "sym_int_vals": None,
+        "time_series": [],
+        "time_series_levels": [[] for _ in time_series_levels],
+        "time_series_spill": None,
+        "time_series_spill_header": None,
+        "task_acquisition": []
+    }
+
+    run_summary_info = {} # Hold summary information about this run.
+    sym_int_vals_info = {}
+    time_series_info = {} # Hold time series information. Indexed by update (unless using a streaming join).
+
+    ########################################
+    # Extract run parameters
+    ########################################
+    run_cfg_path = os.path.join(run_path, "output", "run_config.csv")
+    if not archives.exists(run_cfg_path):
+        run_fragments["status"] = "incomplete"
+        return run_fragments
+
+    run_params = {}
+    for line in utils.iter_csv(run_cfg_path):
+        param = line["parameter"]
+        value = line["value"]
+        run_params[param] = value
+        # Add a subset of parameters to summary information for this run.
+        if param in spec["run_cfg_fields_summary"]:
+            run_summary_info[param] = value
+            sym_int_vals_info[param] = value
+
+    max_pop_size = 0
+    if run_params["POP_SIZE"] == "-1":
+        max_pop_size = int(run_params["GRID_X"]) * int(run_params["GRID_Y"])
+    else:
+        max_pop_size = int(run_params["POP_SIZE"])
+
+    run_summary_info["max_pop_size"] = max_pop_size
+    sym_int_vals_info["max_pop_size"] = max_pop_size
+
+    ########################################
+    # Analyze updates represented in first output file (e.g., OrganismCounts.csv)
+    ########################################
+    updates_path = os.path.join(run_path, "output", spec["output_files"][0]["file"])
+
+    # Output files that are read in full (for time series, population events, or task acquisition)
+    # are loaded in a single read, unless reading in chunks (memory budget) or with a streaming join.
+    # Their summary data lines (and the first file's updates) are picked up during that read,
+    # rather than from an update index (which takes another full scan of the file to build).
+    load_full_files = not (summary_only or streaming_join) and (memory_budget is None)
+    def full_read_fields(output_file, collect_time_series):
+        '''
+        Time series fields, population events, and task acquisition fields to extract from an
+        output file, and every field that has to be read for them (all empty if the file does not
+        need to be read in full).
+        '''
+        time_series_fields = set()
+        if collect_time_series and not streaming_join:
+            time_series_fields = output_file.get("time_series_fields", set())
+        # (population events and task acquisition need a full read of the file, so are skipped in summary-only mode)
+        population_events = {} if summary_only else output_file.get("population_events", {})
+        task_acquisition_fields = set() if summary_only else output_file.get("task_acquisition_fields", set())
+        read_fields = set(time_series_fields) | set(population_events.values()) | set(task_acquisition_fields)
+        return time_series_fields, population_events, task_acquisition_fields, read_fields
+    def load_full_file(file_path, fields, time_series_fields, update_rows):
+        # Time series fields are kept as text (values are written out as they appear in the file)
+        return read_run_columns(
+            file_path,
+            fields = fields | {"update"},
+            cache = cache,
+            cache_dir = cache_dir,
+            dtypes = {field: str for field in time_series_fields if field != "update"},
+            update_rows = update_rows
+        )
+    loaded_files = {}
+
+    # --- Analyze updates represented, setup time series info --
+    updates_line = None
+    if summary_only:
+        # Fast path: look for target update by reading backwards from end of file.
+        updates_line = utils.read_csv_row_from_tail(updates_path, target_update)
+
+    # Updates represented in data are kept as an array (from file's update index, or from the file's
+    # update column if the file is read in full; as whether time series are collected depends on
+    # the updates, the file is read as if they are)
+    updates = np.array([], dtype = np.int64)
+    first_file_time_series_fields, _, _, first_file_fields = full_read_fields(spec["output_files"][0], True)
+    if updates_line is not None:
+        run_finished_target = True
+        run_target_update = target_update
+    else:
+        updates_index = None
+        if load_full_files and len(first_file_fields):
+            update_rows = {target_update: None, None: None}
+            loaded_files[0] = load_full_file(updates_path, first_file_fields, first_file_time_series_fields, update_rows)
+            updates = loaded_files[0].get("update", updates)
+        else:
+            updates_index = utils.load_update_index(updates_path, cache_dir = cache_dir)
+            updates = updates_index["updates"]
+        if len(updates) == 0:
+            run_fragments["status"] = "empty"
+            return run_fragments
+        # Did run finish with respect to target update?
+        run_finished_target = bool(np.any(updates == target_update))
+        run_target_update = updates[np.argmin(np.abs(updates - target_update))].item()
+        if updates_index is None:
+            # Target update, or last update recorded (else, look the row up through the update index)
+            if run_finished_target:
+                updates_line = update_rows[target_update]
+            elif run_target_update == updates[-1]:
+                updates_line = update_rows[None]
+            else:
+                updates_line = utils.read_csv_row(updates_path, run_target_update, cache_dir = cache_dir)
+        else:
+            updates_line = utils.read_csv_row(updates_path, run_target_update, updates_index)
+
+    # Only collect time series if run reached target (and we're not in summary-only mode)
+    collect_time_series = run_finished_target and not summary_only
+
+    # Extract time series updates (for the time series file and for each pyramid level).
+    # Every level is pulled from the same read of each output file.
+    time_series_base_updates = utils.filter_time_points(
+        updates,
+        method = time_series_units,
+        resolution = time_series_resolution
+    ) if collect_time_series else updates[:0]
+    time_series_level_updates = [
+        utils.filter_time_points(updates, method = time_series_units, resolution = level)
+        if collect_time_series else updates[:0]
+        for level in time_series_levels
+    ]
+    time_series_updates = functools.reduce(np.union1d, time_series_level_updates, np.unique(time_series_base_updates))
+    # Run cfg information (and update) starts off each time series row
+    time_series_base_row = {field: run_params[field] for field in spec["run_cfg_fields_time_series"]}
+    if collect_time_series and not streaming_join:
+        time_series_info = {
+            update: dict(time_series_base_row, update = update)
+            for update in time_series_updates.tolist()
+        }
+
+    run_summary_info["update"] = run_target_update
+    run_summary_info["reached_target_update"] = run_finished_target
+    sym_int_vals_info["update"] = run_target_update
+    sym_int_vals_info["reached_target_update"] = run_finished_target
+    # ---
+
+    ########################################
+    # Extract data from each output file
+    ########################################
+    for file_i, output_file in enumerate(spec["output_files"]):
+        file_path = os.path.join(run_path, "output", output_file["file"])
+        prefix = output_file["prefix"]
+        time_series_fields, population_events, task_acquisition_fields, read_fields = full_read_fields(output_file, collect_time_series)
+
+        # Extract summary info
+        if file_i == 0:
+            summary_line = updates_line
+        elif load_full_files and len(read_fields):
+            update_rows = {run_target_update: None}
+            loaded_files[file_i] = load_full_file(file_path, read_fields, time_series_fields, update_rows)
+            summary_line = update_rows[run_target_update]
+        else:
+            summary_line = read_summary_line(
+                file_path,
+                run_target_update,
+                summary_only,
+                cache_dir
+            )
+        run_summary_info.update(
+            extract_summary_data(
+                summary_line = summary_line,
+                fields = output_file.get("summary_fields", None),
+                prefix = prefix
+            )
+        )
+
+        # Update interaction value file
+        if output_file.get("interaction_values", False):
+            sym_int_vals_info.update(
+                extract_summary_data(
+                    summary_line = summary_line
+                )
+            )
+
+        # Load full-resolution data needed for time series info and population events
+        # (time series info is extracted separately if using a streaming join)
+        if not len(read_fields):
+            loaded_files.pop(file_i, None)
+            continue
+        population_events_state = {}
+        task_acquisition_state = {}
+        # Time series fields are kept as text (values are written out as they appear in the file)
+        if file_i in loaded_files:
+            run_data_chunks = [loaded_files.pop(file_i)]
+        else:
+            run_data_chunks = iter_run_columns(
+                file_path,
+                fields = read_fields | {"update"},
+                cache = cache,
+                cache_dir = cache_dir,
+                memory_budget = memory_budget,
+                dtypes = {field: str for field in time_series_fields if field != "update"}
+            )
+        for run_data in run_data_chunks:
+            # Extract extinction/collapse events
+            if len(population_events):
+                update_population_events(
+                    state = population_events_state,
+                    run_data = run_data,
+                    events = population_events,
+                    max_pop_size = max_pop_size,
+                    fractions = collapse_fractions,
+                    last_update = run_target_update
+                )
+
+            # Extract task acquisition metrics
+            if len(task_acquisition_fields):
+                update_task_acquisition(
+                    state = task_acquisition_state,
+                    run_data = run_data,
+                    fields = task_acquisition_fields,
+                    threshold = task_threshold * max_pop_size,
+                    last_update = run_target_update
+                )
+
+            # Extract time series info
+            if len(time_series_fields):
+                add_time_series_info(
+                    time_series_data = time_series_info,
+                    run_data = run_data,
+                    fields = time_series_fields,
+                    prefix = prefix
+                )
+            del run_data
+
+        run_summary_info.update(
+            population_events_info(population_events_state, collapse_fractions, prefix = prefix)
+        )
+        run_fragments["task_acquisition"] += task_acquisition_rows(task_acquisition_state)
+
+    run_fragments["summary"] = run_summary_info
+    run_fragments["sym_int_vals"] = sym_int_vals_info
+
+    if not collect_time_series:
+        return run_fragments
+
+    # Time series rows, in update order
+    if streaming_join:
+        # Pull time series info from all output files at once with a streaming merge-join
+        time_series_files = [
+            output_file for output_file in spec["output_files"]
+            if len(output_file.get("time_series_fields", set()))
+        ]
+        time_series_rows = iter_time_series_rows(
+            sampled_updates = time_series_updates,
+            file_paths = [
+                os.path.join(run_path, "output", output_file["file"])
+                for output_file in time_series_files
+            ],
+            output_files = time_series_files,
+            base_row = time_series_base_row,
+            header = settings["time_series_header"]
+        )
+    else:
+        time_series_rows = (time_series_info[update] for update in time_series_updates.tolist())
+
+    # Sort rows out into time series/pyramid level rows (rows are shared where updates overlap).
+    # With a spill directory, rows are streamed out to (headerless) csv files there instead of
+    # being returned, so that a run's time series is never held in memory.
+    in_base = np.isin(time_series_updates, time_series_base_updates)
+    in_levels = [np.isin(time_series_updates, level_updates) for level_updates in time_series_level_updates]
+    spill_dir = settings["spill_dir"]
+    if spill_dir is None:
+        sinks = [run_fragments["time_series"]] + run_fragments["time_series_levels"]
+    else:
+        spill_paths = [
+            spill_path(spill_dir, run_dir, name)
+            for name in ["time_series"] + [f"time_series_r{level}" for level in time_series_levels]
+        ]
+        sinks = [
+            utils.CSVWriter(path, header = settings["time_series_header"], write_header = False)
+            for path in spill_paths
+        ]
+    for row_i, row in enumerate(time_series_rows):
+        for sink, keep in zip(sinks, [in_base] + in_levels):
+            if not keep[row_i]:
+                continue
+            if spill_dir is None:
+                sink.append(row)
+            else:
+                sink.write_row(row)
+    if spill_dir is not None:
+        for sink in sinks:
+            sink.close()
+        run_fragments["time_series_spill"] = spill_paths
+        run_fragments["time_series_spill_header"] = list(settings["time_series_header"])
+
+    return run_fragments
+
+def scan_schemas(data_dir, run_dirs, spec, threads=8):
+    '''
+    Read the header line of every output file (in spec) for every run, in parallel.
+    Returns a dictionary mapping each output file name to its schema variants: a dictionary
+    from header (tuple of fields) to the list of runs with that header. Runs missing the file
+    (or with an empty file) are listed under the None header.
+    '''
+    file_names = [output_file["file"] for output_file in spec["output_files"]]
+    paths = [
+        os.path.join(data_dir, run_dir, "output", file_name)
+        for run_dir in run_dirs
+        for file_name in file_names
+    ]
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        headers = executor.map(utils.read_csv_header, paths)
+        schemas = {file_name: {} for file_name in file_names}
+        for path_i, header in enumerate(headers):
+            run_dir = run_dirs[path_i // len(file_names)]
+            file_name = file_names[path_i % len(file_names)]
+            key = None if header is None else tuple(header)
+            schemas[file_name].setdefault(key, []).append(run_dir)
+    return schemas
+
+def report_schemas(schemas, max_runs_listed=5):
+    '''
+    Print schema variants found by scan_schemas: for each output file with more than one
+    header, which fields each variant is missing (relative to the union of all headers) and
+    which runs have it.
+    '''
+    for file_name, variants in schemas.items():
+        headers = [header for header in variants if header is not None]
+        union = set().union(*headers) if len(headers) else set()
+        missing_runs = len(variants.get(None, []))
+        print(f"{file_name}: {len(headers)} schema variant(s), {len(union)} fields" + (f" ({missing_runs} run(s) missing file)" if missing_runs else ""))
+        if len(headers) < 2:
+            continue
+        for header, runs in sorted(variants.items(), key = lambda variant: -len(variant[1])):
+            if header is None:
+                continue
+            missing = sorted(union - set(header))
+            description = f"missing {len(missing)} field(s)" + (f": {', '.join(missing)}" if len(missing) else "")
+            listed = ", ".join(runs[:max_runs_listed]) + (", ..." if len(runs) > max_runs_listed else "")
+            print(f"  {len(runs)} run(s), {description} ({listed})")
+
+def union_time_series_header(schemas, spec):
+    '''
+    Time series header covering every run: update, run config time series fields, and each
+    output file's (prefixed) time series fields found in any run's version of that file.
+    '''
+    fields = {"update"} | set(spec["run_cfg_fields_time_series"])
+    for output_file in spec["output_files"]:
+        headers = [header for header in schemas[output_file["file"]] if header is not None]
+        found = set().union(*headers) if len(headers) else set()
+        prefix = output_file["prefix"]
+        for field in output_file.get("time_series_fields", set()):
+            if field in found:
+                fields.add(field if prefix is None else f"{prefix}_{field}")
+    return sorted(fields)
+
+def run_files(data_dir, run_dir, spec):
+    '''
+    Paths of the files aggregated from a run directory.
+    '''
+    output_dir = os.path.join(data_dir, run_dir, "output")
+    return [os.path.join(output_dir, "run_config.csv")] + [
+        os.path.join(output_dir, output_file["file"]) for output_file in spec["output_files"]
+    ]
+
+def map_prefetched(fn, run_dirs, data_dir, spec, prefetcher, lookahead):
+    '''
+    Like map(fn, run_dirs), but files of the next lookahead runs are read in the background
+    (see archives.Prefetcher) while each run is aggregated.
+    '''
+    archives.use_prefetcher(prefetcher)
+    try:
+        for run_i, run_dir in enumerate(run_dirs):
+            for upcoming in run_dirs[run_i:run_i + lookahead + 1]:
+                prefetcher.schedule(run_files(data_dir, upcoming, spec))
+            yield fn(run_dir)
+            prefetcher.release(run_files(data_dir, run_dir, spec))
+    finally:
+        archives.use_prefetcher(None)
+        prefetcher.close()
+
+def map_in_order(executor, fn, items, max_pending):
+    '''
+    Like executor.map, but never has more than max_pending items submitted and waiting
+    to be consumed (executor.map submits everything up front, so finished results pile up
+    in memory whenever the consumer falls behind).
+    '''
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while len(pending):
+        yield pending.popleft().result()
+
+def peak_rss_mb():
+    '''
+    Peak resident set size (in MB) of this process and of its (finished) worker processes.
+    '''
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, workers
+
+def run_fingerprint(run_path):
+    '''
+    Sizes and modification times of a run's output csv files (used to detect new or
+    changed runs when aggregating incrementally).
+    '''
+    output_dir = os.path.join(run_path, "output")
+    fingerprint = {}
+    for name in archives.list_output_files(output_dir):
+        stat = archives.stat(os.path.join(output_dir, name))
+        fingerprint[name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+def spec_signature(spec):
+    '''
+    JSON-friendly version of a spec (sets become sorted lists), used to detect
+    changes to an experiment's spec between incremental aggregations.
+    '''
+    if isinstance(spec, dict):
+        return {key: spec_signature(spec[key]) for key in spec}
+    if isinstance(spec, (set, frozenset)):
+        return sorted(spec)
+    if isinstance(spec, (list, tuple)):
+        return [spec_signature(value) for value in spec]
+    return spec
+
+# Version of the manifest layout (manifests written with another version are discarded)
+manifest_format = 3
+
+def fragment_paths(run_fragments, relative_to=None, resolve_against=None):
+    '''
+    Copy of a run's fragments with its time series spill paths made relative to a directory
+    (for storing them), or resolved against one (for reading them back).
+    '''
+    spill = run_fragments.get("time_series_spill", None)
+    if spill is None:
+        return run_fragments
+    if relative_to is not None:
+        spill = [os.path.relpath(path, relative_to) for path in spill]
+    if resolve_against is not None:
+        spill = [os.path.join(resolve_against, path) for path in spill]
+    return {**run_fragments, "time_series_spill": spill}
+
+def load_manifest(manifest_path, settings):
+    '''
+    Load manifest of previously aggregated runs. Manifest is discarded if it was
+    produced with different aggregation settings.
+    '''
+    manifest = {"settings": settings, "runs": {}}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as fp:
+            prev_manifest = json.load(fp)
+        if prev_manifest.get("settings", None) == settings:
+            manifest["runs"] = prev_manifest.get("runs", {})
+        else:
+            print("Aggregation settings changed since last run; re-aggregating all runs.")
+    return manifest
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(manifest, fp)
+    os.replace(tmp_path, manifest_path)
+
+def main(spec):
+    parser = argparse.ArgumentParser(description = "Aggregate experiment data.")
+    parser.add_argument("--data_dir", type=str, help="Where is the base output directory for each run?")
+    parser.add_argument("--recursive", action="store_true", help="Look for run directories in sub-directories of data_dir (e.g., sharded layouts)")
+    parser.add_argument("--shard", type=int, default=None, help="Only aggregate this shard (0 to num_shards-1) of the run directories")
+    parser.add_argument("--num_shards", type=int, default=1, help="How many shards run directories are split into (see --shard)")
+    parser.add_argument("--run_list", type=str, default=None, help="Csv file listing the run directories (run_dir column, relative to data_dir) to aggregate, instead of discovering them")
+    parser.add_argument("--dump_dir", type=str, help="Where to dump this?", default=".")
+    parser.add_argument("--summary_update", type=int, help="Update to pull summary data for?")
+    parser.add_argument("--time_series_units", type=str, default="interval", choices=["interval", "total"], help="Unit for resolution of time series")
+    parser.add_argument("--time_series_resolution", type=int, default=1, help="What resolution should we collect time series data at?")
+    parser.add_argument("--time_series_pyramid", type=str, default="", help="Comma-separated list of additional time series resolutions to write (one time series file per resolution)")
+    parser.add_argument("--summary_only", action="store_true", help="Only pull summary data (reads output files from the tail; no time series, population events, or task acquisition metrics)")
+    parser.add_argument("--max_memory", type=int, default=None, help="Bounded-memory mode: memory budget (in MB) for reading run output files; reads files in chunks sized to the budget and streams time series extraction")
+    parser.add_argument("--streaming_join", action="store_true", help="Extract time series data by walking each run's output files together in update order (one row per file in memory at a time)")
+    parser.add_argument("--cache", action="store_true", help="Cache parsed output files as binary (.npz) files for faster re-aggregation")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Where to store cache/index files? If none, store them next to each output file")
+    parser.add_argument("--jobs", type=int, default=1, help="How many processes to use for aggregating run directories in parallel?")
+    parser.add_argument("--prefetch_runs", type=int, default=0, help="Read the files of this many upcoming runs in background threads while aggregating (serial aggregation only)")
+    parser.add_argument("--prefetch_threads", type=int, default=4, help="How many threads to use for prefetching run files?")
+    parser.add_argument("--prefetch_memory", type=int, default=256, help="Most memory (in MB) to hold prefetched run files in")
+    parser.add_argument("--incremental", action="store_true", help="Only re-aggregate new or changed runs (tracked by a manifest in dump_dir)")
+    parser.add_argument("--columnar_format", type=str, default=None, choices=["feather", "parquet"], help="Also write output files in a typed, compressed columnar format (requires pyarrow)")
+    parser.add_argument("--columnar_only", action="store_true", help="Only keep columnar output files (remove csv files once converted)")
+    parser.add_argument("--partition_time_series", action="store_true", help="Split time series output into one file per condition (RUN_C{i} prefix)")
+    parser.add_argument("--collapse_fractions", type=str, default="0.5,0.1", help="Comma-separated fractions of max population size to report population collapse events for")
+    parser.add_argument("--task_threshold", type=float, default=0.025, help="Fraction of max population size a task count must reach for the task to count as completed")
+    parser.add_argument("--interaction_histograms", action="store_true", help="Also write every run's full interaction value histogram trajectory as a memory-mappable array")
+    parser.add_argument("--cube", action="store_true", help="Also pack every run's numeric output columns into a memory-mapped (runs x sampled updates x fields) data cube")
+    parser.add_argument("--cube_dtype", type=str, default="float64", choices=["float64", "float32"], help="Data type of data cube values")
+    parser.add_argument("--rollup", action="store_true", help="Also write per-condition, per-update summary statistics of time series fields")
+    parser.add_argument("--bootstrap_samples", type=int, default=1000, help="How many bootstrap resamples to use for rollup confidence intervals?")
+
+    args = parser.parse_args()
+    data_dir = args.data_dir
+    dump_dir = args.dump_dir
+    recursive = args.recursive
+    shard = args.shard
+    num_shards = args.num_shards
+    run_list = args.run_list
+    target_update = args.summary_update
+    time_series_units = args.time_series_units
+    time_series_resolution = args.time_series_resolution
+    summary_only = args.summary_only
+    time_series_levels = [int(level) for level in args.time_series_pyramid.split(",") if level.strip()]
+    max_memory = args.max_memory
+    # Bounded-memory mode always extracts time series with a streaming join
+    streaming_join = args.streaming_join or (max_memory is not None)
+    cache = args.cache
+    cache_dir = args.cache_dir
+    jobs = args.jobs
+    incremental = args.incremental
+    prefetch_runs = args.prefetch_runs
+    columnar_format = args.columnar_format
+    columnar_only = args.columnar_only
+    partition_time_series = args.partition_time_series
+    rollup = args.rollup and not summary_only
+    bootstrap_samples = args.bootstrap_samples
+    task_threshold = args.task_threshold
+    interaction_histograms = args.interaction_histograms
+    build_cube = args.cube
+    cube_dtype = args.cube_dtype
+    collapse_fractions = [float(fraction) for fraction in args.collapse_fractions.split(",") if fraction.strip()]
+
+    if not os.path.exists(data_dir):
+        print("Unable to find data directory.")
+        exit(-1)
+
+    if interaction_histograms and not has_interaction_values(spec):
+        print("Spec has no interaction values file to pull histograms from")
+        exit(-1)
+
+    if (max_memory is not None) and rollup:
+        print("Time series rollup (--rollup) holds every replicate's time series in memory; cannot use it with --max_memory")
+        exit(-1)
+
+    if (shard is not None) and not (0 <= shard < num_shards):
+        print("Shard must be between 0 and num_shards - 1")
+        exit(-1)
+
+    if (run_list is not None) and not os.path.isfile(run_list):
+        print("Unable to find run list.")
+        exit(-1)
+
+    if columnar_only and (columnar_format is None):
+        print("Must specify --columnar_format to use --columnar_only")
+        exit(-1)
+
+    if (prefetch_runs > 0) and (jobs > 1):
+        print("Warning: --prefetch_runs only applies to serial aggregation (--jobs 1); not prefetching")
+
+    # Verify time series resolution >= 1
+    if any(resolution < 1 for resolution in [time_series_resolution] + time_series_levels):
+        print("Time series resolution must be >= 1")
+        exit(-1)
+
+    utils.mkdir_p(dump_dir)
+    if cache_dir is not None:
+        utils.mkdir_p(cache_dir)
+    # Output in dump_dir is not complete until this aggregation finishes
+    done_path = os.path.join(dump_dir, done_marker)
+    if os.path.isfile(done_path):
+        os.remove(done_path)
+
+    # Aggregate run directories.
+    # Find and classify run directories (status table is kept in dump_dir for later tools)
+    run_status_table = discovery.discover_runs(
+        data_dir,
+        output_files = [output_file["file"] for output_file in spec["output_files"]],
+        target_update = target_update,
+        recursive = recursive,
+        threads = max(8, jobs),
+        shard = shard,
+        num_shards = num_shards,
+        run_dirs = None if run_list is None else discovery.load_run_list(run_list)
+    )
+    discovery.write_run_status(os.path.join(dump_dir, "run_status.csv"), run_status_table)
+    run_dirs = [row["run_dir"] for row in run_status_table]
+    if shard is None:
+        print(f"Found {len(run_dirs)} run directories.")
+    else:
+        print(f"Found {len(run_dirs)} run directories in shard {shard} (of {num_shards}).")
+    for status in discovery.run_statuses:
+        print(f"  {status}: {sum(row['status'] == status for row in run_status_table)}")
+
+    settings = {
+        "target_update": target_update,
+        "time_series_units": time_series_units,
+        "time_series_resolution": time_series_resolution,
+        "time_series_levels": time_series_levels,
+        "summary_only": summary_only,
+        "streaming_join": streaming_join,
+        "cache": cache,
+        "cache_dir": cache_dir,
+        # Memory budget (in bytes) for each process reading run output files
+        "memory_budget": None if max_memory is None else (max_memory * 2**20) // max(jobs, 1),
+        "collapse_fractions": collapse_fractions,
+        "task_threshold": task_threshold,
+        # Bounded-memory mode: where runs write out their time series rows (see aggregate_run)
+        "spill_dir": None,
+        "time_series_header": None
+    }
+
+    # Manifest of aggregated runs (file sizes/mtimes + where output fragments are stored)
+    # The spec is included so that editing field sets invalidates previously aggregated runs.
+    # Fragment/spill paths are stored relative to dump_dir (see fragment_paths), so that the
+    # dump directory can be re-aggregated from any working directory.
+    manifest_path = os.path.join(dump_dir, "aggregate_manifest.json")
+    fragments_dir = os.path.join(dump_dir, "fragments")
+    manifest_settings = {
+        "manifest_format": manifest_format,
+        "target_update": target_update,
+        "time_series_units": time_series_units,
+        "time_series_resolution": time_series_resolution,
+        "time_series_levels": time_series_levels,
+        "summary_only": summary_only,
+        "streaming_join": streaming_join,
+        "collapse_fractions": collapse_fractions,
+        "task_threshold": task_threshold,
+        "spec": spec_signature(spec)
+    }
+    manifest = load_manifest(manifest_path, manifest_settings) if incremental else None
+
+    # Scan headers of every run's output files up front. Runs whose output files are missing
+    # fields get "NA" for them in the time series file (union of all runs' fields).
+    print("Scanning output file schemas")
+    schemas = scan_schemas(data_dir, run_dirs, spec, threads = max(8, jobs))
+    report_schemas(schemas)
+
+    # Create writers for output files. Rows are streamed out as each run is processed.
+    # - Time series header is the union of time series fields across all runs
+    time_series_header = union_time_series_header(schemas, spec)
+    settings["time_series_header"] = time_series_header
+    # - In bounded-memory mode, runs spill their time series rows to files (kept with stored
+    #   fragments if aggregating incrementally), which are copied into time series output files
+    if (max_memory is not None) and not summary_only:
+        settings["spill_dir"] = fragments_dir if incremental else os.path.join(dump_dir, "time_series_spill")
+        utils.mkdir_p(settings["spill_dir"])
+    time_series_fpath = os.path.join(dump_dir, f"time_series.csv")
+    time_series_writer = None
+    if not (summary_only or partition_time_series):
+        time_series_writer = utils.CSVWriter(time_series_fpath)
+    # - Time series pyramid files (one per resolution)
+    time_series_level_paths = [
+        os.path.join(dump_dir, f"time_series_r{level}.csv")
+        for level in time_series_levels
+    ]
+    time_series_level_writers = [] if summary_only else [
+        utils.CSVWriter(level_path) for level_path in time_series_level_paths
+    ]
+    # - Partitioned time series files (one per condition), created as conditions are encountered
+    time_series_partition_dir = os.path.join(dump_dir, "time_series")
+    time_series_partition_writers = {}
+    condition_info = {}
+    if partition_time_series and not summary_only:
+        utils.mkdir_p(time_series_partition_dir)
+    summary_path = os.path.join(dump_dir, "summary.csv")
+    # - Per-run files are written once all runs are in, with the union of every run's fields as header
+    summary_writer = utils.CSVWriter(summary_path, union_header = True)
+    sym_int_path = os.path.join(dump_dir, "symbiont_interaction_values.csv")
+    sym_int_vals_writer = utils.CSVWriter(sym_int_path, union_header = True) if has_interaction_values(spec) else None
+    # - Task acquisition files (wide: one line per-replicate; long: one line per-replicate per task)
+    task_acquisition_path = os.path.join(dump_dir, "task_acquisition.csv")
+    task_acquisition_long_path = os.path.join(dump_dir, "task_acquisition_long.csv")
+    task_acquisition_writer = None
+    task_acquisition_long_writer = None
+    if has_task_acquisition(spec) and not summary_only:
+        task_acquisition_writer = utils.CSVWriter(task_acquisition_path, union_header = True)
+        task_acquisition_long_writer = utils.CSVWriter(task_acquisition_long_path, union_header = True)
+    # - Per-condition time series rollup is computed once all runs have been read
+    rollup_path = os.path.join(dump_dir, "time_series_rollup.csv")
+    rollup_fields = time_series_data_fields(spec)
+    rollup_data = {}
+
+    # Figure out which runs need to be (re-)aggregated
+    stale_run_dirs = run_dirs
+    if incremental:
+        utils.mkdir_p(fragments_dir)
+        fingerprints = {
+            run_dir: run_fingerprint(os.path.join(data_dir, run_dir))
+            for run_dir in run_dirs
+        }
+        stale_run_dirs = [
+            run_dir for run_dir in run_dirs
+            if manifest["runs"].get(run_dir, {}).get("files", None) != fingerprints[run_dir]
+        ]
+        print(f"Reusing {len(run_dirs) - len(stale_run_dirs)} previously aggregated runs; aggregating {len(stale_run_dirs)} new or changed runs.")
+        # Forget about runs that no longer exist
+        for run_dir in set(manifest["runs"].keys()) - set(run_dirs):
+            fragment_path = os.path.join(dump_dir, manifest["runs"].pop(run_dir)["fragment"])
+            if os.path.isfile(fragment_path):
+                with open(fragment_path, "r") as fp:
+                    spilled = fragment_paths(json.load(fp), resolve_against = dump_dir)["time_series_spill"] or []
+                for path in [fragment_path] + spilled:
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+    # Aggregate runs (in parallel if multiple jobs requested). Results come back in
+    # run directory order, so output is identical regardless of the number of jobs.
+    aggregate = functools.partial(aggregate_run, data_dir = data_dir, spec = spec, settings = settings)
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers = jobs)
+        stale_run_results = map_in_order(executor, aggregate, stale_run_dirs, 2 * jobs)
+    elif prefetch_runs > 0:
+        prefetcher = archives.Prefetcher(
+            threads = args.prefetch_threads,
+            max_bytes = args.prefetch_memory * 2**20
+        )
+        stale_run_results = map_prefetched(aggregate, stale_run_dirs, data_dir, spec, prefetcher, prefetch_runs)
+    else:
+        stale_run_results = map(aggregate, stale_run_dirs)
+
+    def merge_run_results():
+        '''
+        Yield fragments for every run (in run directory order), splicing freshly
+        aggregated runs in with fragments stored from previous aggregations.
+        '''
+        stale = set(stale_run_dirs)
+        for run_dir in run_dirs:
+            if not run_dir in stale:
+                with open(os.path.join(dump_dir, manifest["runs"][run_dir]["fragment"]), "r") as fp:
+                    yield fragment_paths(json.load(fp), resolve_against = dump_dir)
+                continue
+            run_fragments = next(stale_run_results)
+            if incremental:
+                fragment_path = os.path.join(fragments_dir, f"{run_dir.replace(os.sep, '__')}.json")
+                with open(fragment_path, "w") as fp:
+                    json.dump(fragment_paths(run_fragments, relative_to = dump_dir), fp)
+                manifest["runs"][run_dir] = {
+                    "files": fingerprints[run_dir],
+                    "fragment": os.path.relpath(fragment_path, dump_dir)
+                }
+            yield run_fragments
+
+    run_results = merge_run_results()
+
+    # For each run directory...
+    incomplete_runs = []
+    finished_run_dirs = [] # Runs that reached the target update (those time series are collected for)
+    histogram_runs = []
+    for run_dir_i, run_fragments in enumerate(run_results):
+        run_dir = run_fragments["run_dir"]
+        print(f"...({run_dir_i + 1}/{len(run_dirs)}) aggregated from {run_dir}")
+        if run_fragments["status"] == "incomplete":
+            print("Run did not finish, skipping")
+            incomplete_runs.append(run_dir)
+            continue
+        if run_fragments["status"] == "empty":
+            continue
+        if run_fragments["summary"]["reached_target_update"]:
+            finished_run_dirs.append(run_dir)
+
+        # Track condition parameter values/replicate counts (for partitioned time series index)
+        condition = run_condition(run_dir)
+        if not condition in condition_info:
+            condition_info[condition] = {
+                "condition": condition,
+                "file": os.path.join("time_series", f"{condition}.csv"),
+                "replicates": 0
+            }
+            condition_info[condition].update({
+                field: run_fragments["summary"][field]
+                for field in spec["run_cfg_fields_summary"]
+                if (field != "SEED") and (field in run_fragments["summary"])
+            })
+
+        # Track runs for interaction value histograms
+        if interaction_histograms:
+            histogram_runs.append((
+                run_dir,
+                {
+                    "condition": condition,
+                    **{
+                        field: run_fragments["summary"][field]
+                        for field in sorted(spec["run_cfg_fields_time_series"])
+                        if field in run_fragments["summary"]
+                    }
+                }
+            ))
+
+        # Write summary info out
+        summary_writer.write_row(run_fragments["summary"])
+        if sym_int_vals_writer is not None:
+            sym_int_vals_writer.write_row(run_fragments["sym_int_vals"])
+
+        # Write task acquisition info out
+        if task_acquisition_writer is not None:
+            task_acquisition_writer.write_row(
+                task_acquisition_row(run_fragments["summary"], spec, run_fragments["task_acquisition"])
+            )
+            task_base_info = {
+                field: run_fragments["summary"][field]
+                for field in run_fragments["summary"]
+                if (field in spec["run_cfg_fields_summary"]) or (field == "max_pop_size")
+            }
+            for task_row in run_fragments["task_acquisition"]:
+                task_row.update(task_base_info)
+                task_acquisition_long_writer.write_row(task_row)
+
+        ############################################################
+        # Output time series data for this run
+        time_series_rows = run_fragments["time_series"]
+        time_series_spill = run_fragments["time_series_spill"]
+        if len(time_series_rows) or ((time_series_spill is not None) and os.path.getsize(time_series_spill[0])):
+            # Only runs that contribute time series rows count as replicates of their condition
+            condition_info[condition]["replicates"] += 1
+            # Fields missing from this run (relative to the union header) are filled in as "NA"
+            # Write time series content line-by-line (to this run's condition partition, if partitioning)
+            writer = time_series_writer
+            if partition_time_series:
+                if not condition in time_series_partition_writers:
+                    time_series_partition_writers[condition] = utils.CSVWriter(
+                        os.path.join(dump_dir, condition_info[condition]["file"])
+                    )
+                writer = time_series_partition_writers[condition]
+            # Time series file, then pyramid levels
+            level_writers = [writer] + time_series_level_writers
+            level_rows = [time_series_rows] + run_fragments["time_series_levels"]
+            for level_i, level_writer in enumerate(level_writers):
+                if level_writer.header is None:
+                    level_writer.set_header(time_series_header)
+                if time_series_spill is None:
+                    level_writer.write_rows(level_rows[level_i])
+                    continue
+                # Bounded-memory mode: copy rows spilled by the run over (as-is, unless the union
+                # header changed since they were spilled, e.g., by an earlier incremental aggregation)
+                level_writer.copy_rows(time_series_spill[level_i], header = run_fragments["time_series_spill_header"])
+                if not incremental:
+                    os.remove(time_series_spill[level_i])
+
+            if rollup:
+                add_rollup_run(rollup_data, condition, time_series_rows, rollup_fields)
+        ############################################################
+    if executor is not None:
+        executor.shutdown()
+    if incremental:
+        save_manifest(manifest_path, manifest)
+    summary_writer.close()
+    if sym_int_vals_writer is not None:
+        sym_int_vals_writer.close()
+    if task_acquisition_writer is not None:
+        task_acquisition_writer.close()
+        task_acquisition_long_writer.close()
+    if time_series_writer is not None:
+        time_series_writer.close()
+    for writer in time_series_partition_writers.values():
+        writer.close()
+    for writer in time_series_level_writers:
+        writer.close()
+    if (settings["spill_dir"] is not None) and not incremental:
+        os.rmdir(settings["spill_dir"])
+
+    # Stack interaction value histogram trajectories
+    if interaction_histograms:
+        print("Writing interaction value histograms")
+        write_interaction_histograms(
+            dump_dir,
+            data_dir,
+            histogram_runs,
+            spec,
+            cache,
+            cache_dir,
+            settings["memory_budget"]
+        )
+
+    # Pack run output into data cube
+    if build_cube:
+        print("Building data cube")
+        cube_runs, cube_updates, cube_fields = cube.build_cube(
+            os.path.join(dump_dir, "cube"),
+            data_dir,
+            finished_run_dirs,
+            spec,
+            schemas,
+            time_series_units = time_series_units,
+            time_series_resolution = time_series_resolution,
+            jobs = jobs,
+            cache = cache,
+            cache_dir = cache_dir,
+            dtype = cube_dtype,
+            run_condition = run_condition
+        )
+        print(f"Data cube: {cube_runs} runs x {cube_updates} updates x {cube_fields} fields")
+
+    # Reduce time series to per-condition, per-update statistics
+    if rollup:
+        print("Computing time series rollup")
+        # Keep column order as generated (condition, update, parameters, statistics)
+        with utils.CSVWriter(rollup_path, union_header = True, sort_header = False) as writer:
+            writer.write_rows(iter_rollup_rows(rollup_data, rollup_fields, bootstrap_samples))
+        del rollup_data
+
+    # Write out index of time series partitions
+    time_series_partition_paths = []
+    if partition_time_series and not summary_only:
+        partitions_index_path = os.path.join(time_series_partition_dir, "conditions.csv")
+        conditions = sorted(condition_info.keys(), key = lambda c: (len(c), c))
+        index_fields = ["condition", "file", "replicates"] + [
+            field for field in sorted(spec["run_cfg_fields_summary"])
+            if all(field in condition_info[condition] for condition in conditions)
+        ]
+        with utils.CSVWriter(partitions_index_path, header=index_fields) as writer:
+            writer.write_rows([
+                {field: condition_info[condition][field] for field in index_fields}
+                for condition in conditions
+            ])
+        time_series_partition_paths = [
+            os.path.join(dump_dir, condition_info[condition]["file"])
+            for condition in conditions
+            if condition in time_series_partition_writers
+        ]
+
+    # Convert output files to columnar format
+    if columnar_format is not None:
+        output_paths = [summary_path]
+        if sym_int_vals_writer is not None:
+            output_paths.append(sym_int_path)
+        if task_acquisition_writer is not None:
+            output_paths += [task_acquisition_path, task_acquisition_long_path]
+        if time_series_writer is not None:
+            output_paths.append(time_series_fpath)
+        output_paths += time_series_partition_paths
+        if not summary_only:
+            output_paths += time_series_level_paths
+        if rollup:
+            output_paths.append(rollup_path)
+        for output_path in output_paths:
+            columnar_path = f"{os.path.splitext(output_path)[0]}.{columnar_format}"
+            print(f"Writing {columnar_path}")
+            utils.write_columnar(output_path, columnar_path, columnar_format)
+            if columnar_only:
+                os.remove(output_path)
+
+    # print incomplete runs
+    print("Incomplete runs:")
+    print("\n".join(incomplete_runs))
+
+    # Report peak memory use (to help size jobs)
+    own_rss, workers_rss = peak_rss_mb()
+    print(f"Peak RSS: {own_rss:.1f} MB (main process), {workers_rss:.1f} MB (largest worker process)")
+    if (max_memory is not None) and (max(own_rss, workers_rss) > max_memory):
+        print(f"Warning: peak RSS exceeded --max_memory ({max_memory} MB)")
+
+    # Mark output as complete
+    with open(done_path, "w") as fp:
+        fp.write(f"{len(run_dirs)} run directories\n")
@@ -0,0 +1,398 @@
+'''
+Transparent access to run output files stored in compressed archives.
+
+Finished run directories can be packed up to save space, e.g., RUN_C0_1000.tar.gz in place
+of RUN_C0_1000/. Paths are still given as if runs were unpacked
+(e.g., data_dir/RUN_C0_1000/output/OrganismCounts.csv); if a path does not exist, it is
+looked for in:
+- a gzipped copy of the file itself (OrganismCounts.csv.gz)
+- an archive standing in for one of its parent directories (RUN_C0_1000.tar, .tar.gz, .tgz, or
+  .zip). Archive members may or may not include the top-level directory
+  (RUN_C0_1000/output/OrganismCounts.csv or output/OrganismCounts.csv).
+
+Archive members are found through an index (member name -> location), so reading one
+member does not decompress the whole archive:
+- zip: the archive's own central directory
+- tar/tar.gz: member data offsets, listed once and saved next to the archive
+  ({archive}.index.json; rebuilt if the archive changes). Reading a .tar.gz member only
+  decompresses the archive up to the end of that member.
+
+File sizes (stat, list_output_files) are always content sizes, i.e., the uncompressed size of
+gzipped files and archive members, so that sizes (e.g., in run_status.csv) do not depend on
+how runs are stored.
+
+Reads of (plain) files can also be served from memory by a Prefetcher, which reads upcoming
+files in background threads (see Prefetcher, use_prefetcher).
+'''
+
+import functools
+import gzip
+import io
+import json
+import os
+import tarfile
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+archive_extensions = [".tar.gz", ".tgz", ".tar", ".zip"]
+
+# Prefetcher that open_file serves reads from (None if not prefetching; see use_prefetcher)
+active_prefetcher = None
+
+# Stand-in for os.stat results of files inside archives
+FileStat = namedtuple("FileStat", ["st_size", "st_mtime_ns"])
+
+class MemberReader(io.RawIOBase):
+    '''
+    Raw, seekable reader for a (decompressed) file stream of known size. Supports seeking
+    relative to the end of the stream (gzip/tar streams do not) and closes the archive it
+    came from once closed.
+    '''
+
+    def __init__(self, stream, size, archive=None):
+        self.stream = stream
+        self.size = size
+        self.archive = archive
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            offset = self.size + offset
+            whence = io.SEEK_SET
+        elif whence == io.SEEK_CUR:
+            offset = self.stream.tell() + offset
+            whence = io.SEEK_SET
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            if self.archive is not None:
+                self.archive.close()
+        super().close()
+
+class Prefetcher:
+    '''
+    Reads the raw bytes of upcoming files in a bounded pool of background threads, so that
+    file system latency overlaps with parsing files that were already read. At most max_bytes
+    of file content is held (read or being read) at a time; files scheduled beyond that wait
+    until earlier files are released (reads that were already in progress when released keep their
+    share until they finish). Files that are not prefetched are read from disk as usual.
+    Only plain files are prefetched (not gzipped or archived files).
+    '''
+
+    def __init__(self, threads=4, max_bytes=256 << 20):
+        self.executor = ThreadPoolExecutor(max_workers = threads)
+        self.max_bytes = max_bytes
+        self.reads = {}     # path -> future (file content)
+        self.sizes = {}     # path -> bytes reserved for file
+        self.waiting = deque()
+        self.releasing = [] # (future, size) of released reads that could not be cancelled
+        self.reserved = 0
+
+    def read(self, path):
+        with open(path, "rb") as fp:
+            return fp.read()
+
+    def submit_waiting(self):
+        # Reads released while in progress hold on to their share until they finish
+        for read, size in self.releasing:
+            if read.done():
+                self.reserved -= size
+        self.releasing = [(read, size) for read, size in self.releasing if not read.done()]
+        while len(self.waiting):
+            path = self.waiting[0]
+            if self.reserved + self.sizes[path] > self.max_bytes:
+                break
+            self.waiting.popleft()
+            self.reserved += self.sizes[path]
+            self.reads[path] = self.executor.submit(self.read, path)
+
+    def schedule(self, paths):
+        '''
+        Queue files to be read in the background (in order). Already scheduled files,
+        missing files, and files larger than the memory ceiling are skipped.
+        '''
+        for path in paths:
+            if (path in self.sizes) or (not os.path.isfile(path)):
+                continue
+            size = os.stat(path).st_size
+            if size > self.max_bytes:
+                continue
+            self.sizes[path] = size
+            self.waiting.append(path)
+        self.submit_waiting()
+
+    def get(self, path):
+        '''
+        Content of a prefetched file (waiting on its read if still in progress), or None
+        if the file has not been submitted for reading.
+        '''
+        read = self.reads.get(path, None)
+        if read is None:
+            return None
+        try:
+            return read.result()
+        except OSError:
+            return None
+
+    def release(self, paths):
+        '''
+        Drop prefetched content of files that are no longer needed (making room for more).
+        '''
+        for path in paths:
+            if not path in self.sizes:
+                continue
+            if path in self.reads:
+                read = self.reads.pop(path)
+                if read.cancel() or read.done():
+                    self.reserved -= self.sizes[path]
+                else:
+                    self.releasing.append((read, self.sizes[path]))
+            else:
+                self.waiting.remove(path)
+            del self.sizes[path]
+        self.submit_waiting()
+
+    def close(self):
+        self.executor.shutdown(wait = True, cancel_futures = True)
+        self.reads = {}
+        self.sizes = {}
+        self.waiting.clear()
+        self.releasing = []
+        self.reserved = 0
+
+def use_prefetcher(prefetcher):
+    '''
+    Serve open_file reads from the given prefetcher (None to stop).
+    '''
+    global active_prefetcher
+    active_prefetcher = prefetcher
+
+def archive_for_dir(dir_path):
+    '''
+    Archive standing in for a (missing) directory, or None.
+    '''
+    for extension in archive_extensions:
+        if os.path.isfile(dir_path + extension):
+            return dir_path + extension
+    return None
+
+@functools.lru_cache(maxsize=4096)
+def locate_archive(dir_path):
+    '''
+    Find the archive that holds dir_path (a directory that does not exist on disk).
+    Returns (archive path, path of dir_path inside the archive's directory), or None.
+    '''
+    parts = []
+    while True:
+        if os.path.isdir(dir_path):
+            return None
+        archive_path = archive_for_dir(dir_path)
+        if archive_path is not None:
+            return archive_path, "/".join([os.path.basename(dir_path)] + parts[::-1])
+        parent = os.path.dirname(dir_path)
+        if parent == dir_path:
+            return None
+        parts.append(os.path.basename(dir_path))
+        dir_path = parent
+
+def normalize_member_name(name):
+    return name[2:] if name.startswith("./") else name
+
+def build_tar_index(archive_path):
+    '''
+    List the regular file members of a tar archive: name -> [data offset, size].
+    '''
+    index = {}
+    with tarfile.open(archive_path, "r:*") as archive:
+        for member in archive:
+            if member.isreg():
+                index[normalize_member_name(member.name)] = [member.offset_data, member.size]
+    return index
+
+@functools.lru_cache(maxsize=256)
+def load_archive_index(archive_path, size, mtime):
+    '''
+    Member index of an archive (see module docstring). size and mtime (of the archive)
+    key the in-memory cache, so a changed archive gets re-indexed.
+    '''
+    if archive_path.endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as archive:
+            return {
+                normalize_member_name(info.filename): [None, info.file_size]
+                for info in archive.infolist()
+                if not info.is_dir()
+            }
+    index_path = f"{archive_path}.index.json"
+    if os.path.isfile(index_path):
+        try:
+            with open(index_path, "r") as fp:
+                saved = json.load(fp)
+            if (saved["size"] == size) and (saved["mtime"] == mtime):
+                return saved["members"]
+        except (OSError, ValueError, KeyError):
+            pass
+    members = build_tar_index(archive_path)
+    try:
+        with open(index_path, "w") as fp:
+            json.dump({"size": size, "mtime": mtime, "members": members}, fp)
+    except OSError:
+        # Can't write next to the archive (e.g., read-only directory); just use it in memory.
+        pass
+    return members
+
+def archive_index(archive_path):
+    stat = os.stat(archive_path)
+    return load_archive_index(archive_path, stat.st_size, stat.st_mtime_ns)
+
+def find_member(file_path):
+    '''
+    Locate a (missing) file inside an archive.
+    Returns (archive path, member name, member info), or None.
+    '''
+    located = locate_archive(os.path.dirname(os.path.abspath(file_path)))
+    if located is None:
+        return None
+    archive_path, inner_dir = located
+    index = archive_index(archive_path)
+    name = f"{inner_dir}/{os.path.basename(file_path)}"
+    # Members may be stored with or without the top-level (archived) directory
+    for candidate in [name, name.split("/", 1)[1] if "/" in name else None]:
+        if (candidate is not None) and (candidate in index):
+            return archive_path, candidate, index[candidate]
+    return None
+
+def exists(file_path):
+    '''
+    Does the file exist (on disk, gzipped, or in an archive)?
+    '''
+    if os.path.isfile(file_path) or os.path.isfile(f"{file_path}.gz"):
+        return True
+    return find_member(file_path) is not None
+
+def stat(file_path):
+    '''
+    Size and modification time of a file (on disk, gzipped, or in an archive). Sizes are
+    content (uncompressed) sizes: gzipped files get their uncompressed size, files in archives
+    get their member size (and the archive's modification time).
+    '''
+    if os.path.isfile(file_path):
+        return os.stat(file_path)
+    if os.path.isfile(f"{file_path}.gz"):
+        return FileStat(gzip_size(f"{file_path}.gz"), os.stat(f"{file_path}.gz").st_mtime_ns)
+    member = find_member(file_path)
+    if member is None:
+        raise FileNotFoundError(file_path)
+    archive_path, _, (_, size) = member
+    return FileStat(size, os.stat(archive_path).st_mtime_ns)
+
+def gzip_size(gz_path):
+    '''
+    Uncompressed size of a gzip file (from its trailer; modulo 2^32). 0 if the file is too
+    short to have a trailer (e.g., cut off).
+    '''
+    with open(gz_path, "rb") as fp:
+        if fp.seek(0, os.SEEK_END) < 4:
+            return 0
+        fp.seek(-4, os.SEEK_END)
+        return int.from_bytes(fp.read(4), "little")
+
+def fast_seek(file_path):
+    '''
+    Can the file be read from any offset without decompressing everything before it? True for
+    plain files and members of (uncompressed) .tar archives. Seeking backwards in a gzipped,
+    .tar.gz/.tgz or .zip member starts decompressing over from the beginning of the member.
+    '''
+    if os.path.isfile(file_path):
+        return True
+    if os.path.isfile(f"{file_path}.gz"):
+        return False
+    member = find_member(file_path)
+    return (member is not None) and member[0].endswith(".tar")
+
+def open_member(file_path):
+    '''
+    Open a gzipped or archived file as a raw, seekable binary stream.
+    '''
+    gz_path = f"{file_path}.gz"
+    if os.path.isfile(gz_path):
+        return MemberReader(gzip.open(gz_path, "rb"), gzip_size(gz_path))
+    member = find_member(file_path)
+    if member is None:
+        raise FileNotFoundError(file_path)
+    archive_path, name, (offset, size) = member
+    if archive_path.endswith(".zip"):
+        archive = zipfile.ZipFile(archive_path)
+        return MemberReader(archive.open(name), size, archive)
+    archive = tarfile.open(archive_path, "r:*")
+    info = tarfile.TarInfo(name)
+    info.offset_data = offset
+    info.size = size
+    return MemberReader(archive.extractfile(info), size, archive)
+
+def open_file(file_path, mode="r"):
+    '''
+    Open a run output file for reading ("r": text, "rb": binary), whether it is on disk,
+    gzipped, or in an archive.
+    '''
+    if active_prefetcher is not None:
+        content = active_prefetcher.get(file_path)
+        if content is not None:
+            reader = io.BytesIO(content)
+            return io.TextIOWrapper(reader, newline="") if mode == "r" else reader
+    if os.path.isfile(file_path):
+        return open(file_path, mode, newline="") if mode == "r" else open(file_path, mode)
+    reader = io.BufferedReader(open_member(file_path))
+    return io.TextIOWrapper(reader, newline="") if mode == "r" else reader
+
+def list_output_files(output_dir):
+    '''
+    Sizes of the csv files in a run output directory (on disk, gzipped, or archived):
+    file name -> content (uncompressed) size, as from stat (gzipped files are listed under
+    their uncompressed name).
+    '''
+    sizes = {}
+    if os.path.isdir(output_dir):
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(".csv"):
+                    sizes[entry.name] = entry.stat().st_size
+                elif entry.name.endswith(".csv.gz") and not (entry.name[:-3] in sizes):
+                    sizes[entry.name[:-3]] = gzip_size(entry.path)
+        return sizes
+    located = locate_archive(os.path.abspath(output_dir))
+    if located is None:
+        return sizes
+    archive_path, inner_dir = located
+    inner_dirs = [inner_dir, inner_dir.split("/", 1)[1] if "/" in inner_dir else None]
+    for name, (_, size) in archive_index(archive_path).items():
+        member_dir, file_name = os.path.split(name)
+        if (member_dir in inner_dirs) and file_name.endswith(".csv"):
+            sizes[file_name] = size
+    return sizes
+
+def run_dir_name(file_name):
+    '''
+    Name of the run directory an archive stands in for (None if not an archive).
+    '''
+    for extension in archive_extensions:
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return None
@@ -0,0 +1,184 @@
+'''
+Experiment data cube: every run's numeric output columns packed into a single
+memory-mapped array (runs x sampled updates x fields), built in parallel from each run's
+output csv files. Used by aggregation.py (--cube).
+
+Files written (in cube_dir):
+- cube.npy: (runs x updates x fields) float array; NaN where a run has no value (e.g., a run
+  that did not reach an update, or a non-numeric field). Open with numpy.load(..., mmap_mode="r").
+- updates.npy: update of each position along the update axis
+- runs.csv: one line per run (row along the run axis): run directory, condition, run parameters
+- fields.csv: one line per field (position along the field axis): output file, field, and
+  the (prefixed) name it goes by in the time series file
+
+Cross-run reads are then a single strided read, e.g., host count at update 1000 for every run:
+    cube[:, np.searchsorted(updates, 1000), field_index]
+'''
+
+import functools
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import archives
+import utilities as utils
+
+def cube_fields(spec, schemas):
+    '''
+    Field table: every (non-update) field found in any run's version of each output file
+    (see aggregation.scan_schemas), in spec order.
+    '''
+    fields = []
+    for output_file in spec["output_files"]:
+        headers = [header for header in schemas[output_file["file"]] if header is not None]
+        found = set().union(*headers) if len(headers) else set()
+        found.discard("update")
+        prefix = output_file["prefix"]
+        for field in sorted(found):
+            fields.append({
+                "field_index": len(fields),
+                "file": output_file["file"],
+                "field": field,
+                "name": field if prefix is None else f"{prefix}_{field}"
+            })
+    return fields
+
+def scan_run(run_dir, data_dir, spec, cache_dir=None):
+    '''
+    First pass over a run: its run parameters and the updates it recorded (from the
+    first output file's update index). Runs without a run_config.csv have no parameters.
+    '''
+    output_dir = os.path.join(data_dir, run_dir, "output")
+    run_cfg_path = os.path.join(output_dir, "run_config.csv")
+    updates_path = os.path.join(output_dir, spec["output_files"][0]["file"])
+    if not (archives.exists(run_cfg_path) and archives.exists(updates_path)):
+        return None, None
+    run_params = {line["parameter"]: line["value"] for line in utils.iter_csv(run_cfg_path)}
+    updates = utils.load_update_index(updates_path, cache_dir = cache_dir)["updates"]
+    return run_params, updates
+
+def fill_run(run, data_dir, cube_path, fields, updates, cache=False, cache_dir=None):
+    '''
+    Second pass over a run: write its values into its slice of the (already allocated) cube.
+    run is a (run index, run directory) pair. Each worker opens the cube itself.
+    '''
+    run_i, run_dir = run
+    cube = np.load(cube_path, mmap_mode = "r+")
+    file_fields = {}
+    for field in fields:
+        file_fields.setdefault(field["file"], []).append(field)
+    for file_name, entries in file_fields.items():
+        file_path = os.path.join(data_dir, run_dir, "output", file_name)
+        if not archives.exists(file_path):
+            continue
+        if cache:
+            run_data = utils.read_csv_columns_cached(file_path, cache_dir = cache_dir)
+        else:
+            run_data = utils.read_csv_columns(file_path)
+        if not "update" in run_data:
+            continue
+        # Keep only rows at sampled updates
+        positions = np.searchsorted(updates, run_data["update"])
+        positions = np.minimum(positions, len(updates) - 1)
+        sampled = updates[positions] == run_data["update"]
+        positions = positions[sampled]
+        for entry in entries:
+            values = run_data.get(entry["field"], None)
+            if (values is None) or (values.dtype.kind not in "iuf"):
+                continue
+            cube[run_i, positions, entry["field_index"]] = values[sampled]
+        del run_data
+    cube.flush()
+    del cube
+    return run_dir
+
+def build_cube(
+    cube_dir,
+    data_dir,
+    run_dirs,
+    spec,
+    schemas,
+    time_series_units = "interval",
+    time_series_resolution = 1,
+    jobs = 1,
+    cache = False,
+    cache_dir = None,
+    dtype = np.float64,
+    run_condition = None
+):
+    '''
+    Build the experiment data cube (see module docstring) from the given runs.
+    The update axis samples (time_series_units/resolution, as for time series output) the
+    union of updates recorded across runs. Runs without a run_config.csv are left out.
+    '''
+    utils.mkdir_p(cube_dir)
+    executor = ProcessPoolExecutor(max_workers = jobs) if jobs > 1 else None
+    run_map = executor.map if executor is not None else map
+
+    # First pass: run parameters and recorded updates
+    scanned = run_map(
+        functools.partial(scan_run, data_dir = data_dir, spec = spec, cache_dir = cache_dir),
+        run_dirs
+    )
+    runs = []
+    all_updates = np.array([], dtype = np.int64)
+    for run_dir, (run_params, run_updates) in zip(run_dirs, scanned):
+        if run_params is None:
+            continue
+        runs.append((run_dir, run_params))
+        all_updates = np.union1d(all_updates, run_updates)
+    updates = np.array(
+        utils.filter_time_points(all_updates, time_series_units, time_series_resolution)
+        if len(all_updates) else [],
+        dtype = np.int64
+    )
+    fields = cube_fields(spec, schemas)
+
+    # Allocate cube, then fill in each run's slice in parallel
+    cube_path = os.path.join(cube_dir, "cube.npy")
+    cube = np.lib.format.open_memmap(
+        cube_path,
+        mode = "w+",
+        dtype = dtype,
+        shape = (len(runs), len(updates), len(fields))
+    )
+    cube[:] = np.nan
+    cube.flush()
+    del cube
+    np.save(os.path.join(cube_dir, "updates.npy"), updates)
+    if len(updates):
+        filled = run_map(
+            functools.partial(
+                fill_run,
+                data_dir = data_dir,
+                cube_path = cube_path,
+                fields = fields,
+                updates = updates,
+                cache = cache,
+                cache_dir = cache_dir
+            ),
+            [(run_i, run_dir) for run_i, (run_dir, _) in enumerate(runs)]
+        )
+        for _ in filled:
+            pass
+    if executor is not None:
+        executor.shutdown()
+
+    # Run and field tables
+    # Run parameters kept: summary run config fields that appear in any run's configuration
+    found_params = set()
+    for _, run_params in runs:
+        found_params.update(run_params.keys())
+    run_fields = sorted(set(spec["run_cfg_fields_summary"]) & found_params)
+    with utils.CSVWriter(os.path.join(cube_dir, "runs.csv")) as writer:
+        writer.set_header(["run_index", "run_dir", "condition"] + run_fields)
+        for run_i, (run_dir, run_params) in enumerate(runs):
+            row = {field: run_params[field] for field in run_fields if field in run_params}
+            row["run_index"] = run_i
+            row["run_dir"] = run_dir
+            row["condition"] = run_condition(run_dir) if run_condition is not None else "NA"
+            writer.write_row(row)
+    with utils.CSVWriter(os.path.join(cube_dir, "fields.csv"), header = ["field_index", "name", "file", "field"]) as writer:
+        writer.write_rows(fields)
+
+    return len(runs), len(updates), len(fields)
@@ -0,0 +1,240 @@
+'''
+Run directory discovery.
+
+Finds run directories (RUN_*) under a data directory with os.scandir (optionally recursing
+into sharded layouts, e.g., data_dir/shard_0/RUN_C0_1000), then classifies each run from a
+thread pool (metadata calls on shared filesystems are slow, but they are mostly waiting):
+- which output files exist and their sizes (run directories may be archived; see archives.py)
+- last recorded update (read from the end of the first output file)
+- status:
+  - complete: run_config.csv exists and the run recorded the target update (if one is given)
+  - incomplete: run has output, but no run_config.csv or it did not reach the target update
+  - never-started: no output directory (or nothing in it)
+
+The status table (one line per run) is written out as a csv file for later tools
+(see load_run_status). A list of run directories can also be frozen into a csv file
+(write_run_list) so that later passes (e.g., every task of a sharded aggregation) work from
+the same runs, in the same order, even if run directories are added in the meantime.
+Can also be run as a script:
+
+python discovery.py --data_dir <data dir> --output <status table csv> [--summary_update N] [--recursive]
+'''
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import archives
+import utilities as utils
+
+run_identifier = "RUN_"
+
+run_statuses = ["complete", "incomplete", "never-started"]
+
+def scan_dir(path):
+    '''
+    Split a directory's entries into run directories and other sub-directories.
+    Archived run directories (e.g., RUN_C0_1000.tar.gz; see archives.py) are listed
+    as the run directory they stand in for.
+    '''
+    run_dirs = set()
+    other_dirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not run_identifier in entry.name:
+                if entry.is_dir():
+                    other_dirs.append(entry.path)
+                continue
+            if entry.is_dir():
+                run_dirs.add(entry.path)
+            elif archives.run_dir_name(entry.name) is not None:
+                run_dirs.add(os.path.join(path, archives.run_dir_name(entry.name)))
+    return list(run_dirs), other_dirs
+
+def find_run_dirs(data_dir, recursive=False, threads=8):
+    '''
+    Find run directories in data_dir. If recursive, also look inside every sub-directory
+    that is not itself a run directory (directories at each level are scanned in parallel).
+    Returns run directory paths relative to data_dir, sorted.
+    '''
+    run_paths, pending = scan_dir(data_dir)
+    if recursive:
+        with ThreadPoolExecutor(max_workers = threads) as executor:
+            while len(pending):
+                scanned = list(executor.map(scan_dir, pending))
+                pending = []
+                for level_runs, level_dirs in scanned:
+                    run_paths += level_runs
+                    pending += level_dirs
+    return sorted(os.path.relpath(run_path, data_dir) for run_path in run_paths)
+
+def shard_run_dirs(run_dirs, shard, num_shards):
+    '''
+    Run directories in one of num_shards contiguous (near-equal) blocks of run_dirs.
+    Concatenating shards 0..num_shards-1 gives back run_dirs, in order.
+    '''
+    start = (len(run_dirs) * shard) // num_shards
+    stop = (len(run_dirs) * (shard + 1)) // num_shards
+    return run_dirs[start:stop]
+
+def last_recorded_update(file_path):
+    '''
+    Last update recorded in an output file, read backwards from the end of the file (or, for
+    compressed files, which can't be read backwards efficiently, in a single forward pass).
+    Partially written lines (e.g., from a killed job) are skipped.
+    Returns None if the file has no (complete) data lines.
+    '''
+    header = utils.read_csv_header(file_path)
+    if (header is None) or (not "update" in header):
+        return None
+    update_col = header.index("update")
+
+    def line_update(line):
+        values = line.split(b",")
+        if len(values) < len(header):
+            return None
+        try:
+            return int(values[update_col])
+        except ValueError:
+            return None
+
+    with archives.open_file(file_path, "rb") as fp:
+        fp.readline()
+        if not archives.fast_seek(file_path):
+            # Read forward in blocks, keeping the last complete line of each block
+            last_update = None
+            remainder = b""
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                lines = (remainder + block).split(b"\n")
+                remainder = lines.pop()
+                for line in reversed(lines):
+                    update = line_update(line.rstrip(b"\r"))
+                    if update is not None:
+                        last_update = update
+                        break
+            update = line_update(remainder.rstrip(b"\r"))
+            return last_update if update is None else update
+        for line in utils.iter_lines_reversed(fp, start = fp.tell()):
+            update = line_update(line)
+            if update is not None:
+                return update
+    return None
+
+def run_status(run_path, output_files=None, target_update=None):
+    '''
+    Classify a single run directory (see module docstring).
+    output_files is the list of output files to report on, in order; the first one is used
+    to find the last recorded update. If None, every csv file in the output directory is
+    reported (and OrganismCounts.csv is used for the last recorded update).
+    '''
+    output_dir = os.path.join(run_path, "output")
+    sizes = archives.list_output_files(output_dir)
+    if output_files is None:
+        output_files = sorted(name for name in sizes if name != "run_config.csv")
+        updates_file = "OrganismCounts.csv"
+    else:
+        updates_file = output_files[0]
+
+    last_update = None
+    if updates_file in sizes:
+        last_update = last_recorded_update(os.path.join(output_dir, updates_file))
+
+    if not len(sizes):
+        status = "never-started"
+    elif ("run_config.csv" in sizes) and ((target_update is None) or ((last_update is not None) and (last_update >= target_update))):
+        status = "complete"
+    else:
+        status = "incomplete"
+
+    return {
+        "status": status,
+        "last_update": "NA" if last_update is None else last_update,
+        "files": [name for name in output_files if name in sizes],
+        "sizes": {name: sizes[name] for name in output_files if name in sizes}
+    }
+
+def discover_runs(data_dir, output_files=None, target_update=None, recursive=False, threads=8, shard=None, num_shards=1, run_dirs=None):
+    '''
+    Find and classify every run directory in data_dir (see find_run_dirs, run_status), or
+    only the given run_dirs (relative to data_dir, e.g., from load_run_list) if any.
+    If shard is given, only run directories in that shard are classified (see shard_run_dirs).
+    Returns one status table row per run, in run directory order.
+    '''
+    if run_dirs is None:
+        run_dirs = find_run_dirs(data_dir, recursive = recursive, threads = threads)
+    if shard is not None:
+        run_dirs = shard_run_dirs(run_dirs, shard, num_shards)
+    with ThreadPoolExecutor(max_workers = threads) as executor:
+        statuses = list(executor.map(
+            lambda run_dir: run_status(os.path.join(data_dir, run_dir), output_files, target_update),
+            run_dirs
+        ))
+    table = []
+    for run_dir, status in zip(run_dirs, statuses):
+        row = {
+            "run_dir": run_dir,
+            "status": status["status"],
+            "last_update": status["last_update"],
+            "files": ";".join(status["files"])
+        }
+        for name, size in status["sizes"].items():
+            row[f"{name}_size"] = size
+        table.append(row)
+    return table
+
+def write_run_status(output_path, table):
+    '''
+    Write a status table (see discover_runs) out as a csv file.
+    Size columns cover every output file seen in any run ("NA" where a run is missing it).
+    '''
+    size_fields = sorted({field for row in table for field in row if field.endswith("_size")})
+    header = ["run_dir", "status", "last_update", "files"] + size_fields
+    with utils.CSVWriter(output_path, header = header) as writer:
+        writer.write_rows(table)
+
+def write_run_list(output_path, run_dirs):
+    '''
+    Freeze a list of run directories (see find_run_dirs) into a csv file (run_dir column).
+    '''
+    with utils.CSVWriter(output_path, header = ["run_dir"]) as writer:
+        writer.write_rows({"run_dir": run_dir} for run_dir in run_dirs)
+
+def load_run_list(path):
+    '''
+    Load a list of run directories written by write_run_list (in order).
+    '''
+    return [row["run_dir"] for row in utils.iter_csv(path)]
+
+def load_run_status(path):
+    '''
+    Load a status table written by write_run_status.
+    Returns a dictionary mapping each run directory to its status table row.
+    '''
+    return {row["run_dir"]: row for row in utils.iter_csv(path)}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Find and classify run directories.")
+    parser.add_argument("--data_dir", type=str, help="Where is the base output directory for each run?")
+    parser.add_argument("--output", type=str, default="run_status.csv", help="Where to write the run status table?")
+    parser.add_argument("--summary_update", type=int, default=None, help="Update a run must reach to be complete")
+    parser.add_argument("--recursive", action="store_true", help="Look for run directories in sub-directories (e.g., sharded layouts)")
+    parser.add_argument("--threads", type=int, default=8, help="How many threads to use for file system calls?")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.data_dir):
+        print("Unable to find data directory.")
+        exit(-1)
+
+    table = discover_runs(
+        args.data_dir,
+        target_update = args.summary_update,
+        recursive = args.recursive,
+        threads = args.threads
+    )
+    write_run_status(args.output, table)
+    for status in run_statuses:
+        print(f"{status}: {sum(row['status'] == status for row in table)}")
+
+if __name__ == "__main__":
+    main()
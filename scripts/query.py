@@ -0,0 +1,343 @@
+'''
+Lazy queries over aggregated experiment data.
+
+select(experiment, where={param: value}, fields=[...], updates=range(...)) pulls the
+requested time series fields for matching runs out of an aggregation dump directory
+(aggregation.py --dump_dir), without loading anything else:
+- If the dump directory has a data cube (aggregation.py --cube), fields are strided reads from
+  the memory-mapped cube.
+- Otherwise, fields are loaded from the time series file: only the requested columns are read
+  (from time_series.feather/.parquet, see aggregation.py --columnar_format, if pyarrow is
+  installed; else from time_series.csv, in a single pass for all missing columns). Missing values
+  ("NA") come back as NaN.
+- If the time series were partitioned by condition (aggregation.py --partition_time_series),
+  time_series/conditions.csv is used to pick the conditions that can match where, and only
+  their time series files (time_series/C{i}.*) are loaded.
+where values match a run parameter either as written in run configurations, or as numbers (so
+"0.50", 0.5, and "0.5" all match a multiplier of 0.5).
+Recently used columns (and opened cubes/run tables) are kept in an LRU cache, so repeated
+queries against the same experiment do not touch the disk again.
+
+Example (in a notebook/interpreter, from the scripts directory):
+    import query
+    result = query.select(
+        "path/to/dump_dir",
+        where = {"HEALTH_TYPE": "parasite"},
+        fields = ["OrgCounts_host_count"],
+        updates = range(0, 200001, 500)
+    )
+    result["OrgCounts_host_count"] # (matching runs x selected updates) array
+'''
+
+import functools
+import os
+from collections import OrderedDict
+import numpy as np
+
+import utilities as utils
+
+# How many columns to keep in memory across queries
+column_cache_size = 256
+
+# Recently used columns: (path, file version, field) -> array, least recently used first
+column_cache = OrderedDict()
+
+# Time series file formats, in order of preference (columnar formats need pyarrow)
+time_series_formats = ["feather", "parquet", "csv"]
+
+# How missing values appear in time series files
+missing_values = ["NA", "", "None"]
+
+def file_version(path):
+    '''
+    (size, modification time) of a file; part of cache keys so that re-aggregated data is reloaded.
+    '''
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def time_series_file(experiment):
+    '''
+    Path of an experiment's time series file (see time_series_formats), or None if it has none.
+    '''
+    return data_file(os.path.join(experiment, "time_series"))
+
+def data_file(base_path):
+    '''
+    Path of the preferred available format (see time_series_formats) of the data file at
+    base_path (without extension), or None if there is none.
+    '''
+    for file_format in time_series_formats:
+        path = f"{base_path}.{file_format}"
+        if not os.path.isfile(path):
+            continue
+        if file_format != "csv":
+            try:
+                import pyarrow
+            except ImportError:
+                continue
+        return path
+    return None
+
+def read_columns(path, fields):
+    '''
+    Read only the given columns of a csv, feather, or parquet file.
+    Returns a dictionary of field name -> array (fields not in the file are left out).
+    '''
+    if path.endswith(".csv"):
+        return utils.read_csv_columns(path, fields = set(fields))
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    if path.endswith(".parquet"):
+        found = set(pq.read_schema(path).names)
+        table = pq.read_table(path, columns = [field for field in fields if field in found])
+    else:
+        found = set(feather.read_table(path, columns = [], memory_map = True).schema.names)
+        table = feather.read_table(path, columns = [field for field in fields if field in found], memory_map = True)
+    return {
+        field: table.column(field).to_numpy(zero_copy_only = False)
+        for field in table.schema.names
+    }
+
+def file_fields(path):
+    '''
+    Column names of a csv, feather, or parquet file.
+    '''
+    if path.endswith(".csv"):
+        return utils.read_csv_header(path) or []
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+    if path.endswith(".parquet"):
+        return pq.read_schema(path).names
+    return feather.read_table(path, columns = [], memory_map = True).schema.names
+
+def load_columns(path, fields):
+    '''
+    Load columns of a time series file through the column cache. Columns that are not cached
+    yet are read together, in a single pass over the file.
+    '''
+    version = file_version(path)
+    missing = [field for field in dict.fromkeys(fields) if not (path, version, field) in column_cache]
+    if len(missing):
+        columns = read_columns(path, missing)
+        for field in missing:
+            if not field in columns:
+                raise KeyError(f"{field} not found in {path}")
+            column_cache[(path, version, field)] = columns[field]
+    loaded = {}
+    for field in fields:
+        column_cache.move_to_end((path, version, field))
+        loaded[field] = column_cache[(path, version, field)]
+    while len(column_cache) > column_cache_size:
+        column_cache.popitem(last = False)
+    return loaded
+
+def numeric_values(values):
+    '''
+    Column as float64 values, with missing values (see missing_values, or nulls) as NaN.
+    '''
+    if values.dtype.kind in "biuf":
+        return values.astype(np.float64)
+    values = values.astype(str)
+    numeric = np.full(len(values), np.nan)
+    present = ~np.isin(values, missing_values)
+    numeric[present] = values[present].astype(np.float64)
+    return numeric
+
+@functools.lru_cache(maxsize=16)
+def load_cube(cube_dir, version):
+    '''
+    Open an experiment data cube (see cube.py): memory-mapped cube, update axis, run table,
+    and field name -> field index.
+    '''
+    cube = np.load(os.path.join(cube_dir, "cube.npy"), mmap_mode = "r")
+    updates = np.load(os.path.join(cube_dir, "updates.npy"))
+    runs = utils.read_csv_columns(os.path.join(cube_dir, "runs.csv"), dtypes = {"run_dir": str})
+    fields = {
+        row["name"]: int(row["field_index"])
+        for row in utils.iter_csv(os.path.join(cube_dir, "fields.csv"))
+    }
+    return cube, updates, runs, fields
+
+def update_mask(updates, selection):
+    '''
+    Which of the given updates are selected: all (None), a range, or any collection of updates.
+    '''
+    if selection is None:
+        return np.ones(len(updates), dtype = bool)
+    if isinstance(selection, range):
+        return (
+            (updates >= selection.start) &
+            (updates < selection.stop) &
+            ((updates - selection.start) % selection.step == 0)
+        )
+    return np.isin(updates, list(selection))
+
+def parse_number(value):
+    '''
+    value as a float, or None if it is not a number.
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def parsed_numbers(values):
+    '''
+    Column as float64 values, with values that are not numbers as NaN. Each distinct value is
+    parsed once (run parameter columns only hold a few).
+    '''
+    if values.dtype.kind in "biuf":
+        return values.astype(np.float64)
+    distinct, inverse = np.unique(values.astype(str), return_inverse = True)
+    numbers = np.array([parse_number(value) for value in distinct], dtype = np.float64)
+    return numbers[inverse.reshape(-1)]
+
+def value_mask(values, value):
+    '''
+    Which values match value: either as strings (as they appear in run configurations), or
+    as numbers if value is one (columns may have been read as int/float, e.g. 1 -> 1.0).
+    '''
+    mask = values.astype(str) == str(value)
+    number = parse_number(value)
+    if number is not None:
+        mask |= parsed_numbers(values) == number
+    return mask
+
+def where_mask(columns, where, size):
+    '''
+    Which rows match every param: value pair in where (see value_mask).
+    '''
+    mask = np.ones(size, dtype = bool)
+    for param, value in (where or {}).items():
+        if not param in columns:
+            raise KeyError(f"Cannot filter on {param}: not a run parameter in this experiment's data")
+        mask &= value_mask(columns[param], value)
+    return mask
+
+def select_from_cube(cube_dir, where, fields, updates):
+    cube, cube_updates, runs, field_index = load_cube(cube_dir, file_version(os.path.join(cube_dir, "cube.npy")))
+    run_rows = np.flatnonzero(where_mask(runs, where, len(runs["run_dir"])))
+    update_cols = np.flatnonzero(update_mask(cube_updates, updates))
+    result = {
+        "runs": {param: values[run_rows] for param, values in runs.items()},
+        "updates": cube_updates[update_cols]
+    }
+    for field in fields:
+        if not field in field_index:
+            raise KeyError(f"{field} not found in data cube")
+        result[field] = cube[np.ix_(run_rows, update_cols, [field_index[field]])][:, :, 0]
+    return result
+
+def select_from_time_series(time_series_path, where, fields, updates):
+    params = list(where or {})
+    columns = load_columns(time_series_path, ["SEED", "update"] + params + fields)
+    # Replicates are told apart by their SEED
+    seeds = columns["SEED"]
+    row_updates = columns["update"]
+    params = {param: columns[param] for param in params}
+    rows = np.flatnonzero(where_mask(params, where, len(seeds)) & update_mask(row_updates, updates))
+    run_seeds, run_of_row = np.unique(seeds[rows], return_inverse = True)
+    selected_updates, update_of_row = np.unique(row_updates[rows], return_inverse = True)
+    # Run table: first row of each matching run
+    first_rows = rows[np.unique(run_of_row, return_index = True)[1]]
+    result = {
+        "runs": {"SEED": run_seeds},
+        "updates": selected_updates
+    }
+    for param in params:
+        result["runs"][param] = params[param][first_rows]
+    for field in fields:
+        table = np.full((len(run_seeds), len(selected_updates)), np.nan)
+        table[run_of_row, update_of_row] = numeric_values(columns[field][rows])
+        result[field] = table
+    return result
+
+def select_from_partitions(partition_dir, where, fields, updates):
+    '''
+    Select from time series partitioned by condition: partitions whose condition parameters
+    (time_series/conditions.csv) cannot match where are not loaded; the rest are selected from
+    one by one and stacked (updates are the union of every partition's selected updates).
+    Parameters that are in conditions.csv but not in a partition's time series file (e.g.,
+    summary-only run configuration fields) are only filtered on through conditions.csv, and
+    come from there in the run table.
+    '''
+    index_path = os.path.join(partition_dir, "conditions.csv")
+    header = utils.read_csv_header(index_path) or []
+    conditions = utils.read_csv_columns(index_path, dtypes = {field: str for field in header})
+    if not len(conditions):
+        conditions = {field: np.array([], dtype = str) for field in header}
+    index_where = {param: value for param, value in (where or {}).items() if param in conditions}
+    partitions = []
+    # (conditions without replicates have no time series file)
+    has_replicates = conditions["replicates"] != "0"
+    for condition_i in np.flatnonzero(where_mask(conditions, index_where, len(conditions["file"])) & has_replicates):
+        condition_file = conditions["file"][condition_i]
+        path = data_file(os.path.join(os.path.dirname(partition_dir), os.path.splitext(condition_file)[0]))
+        if path is None:
+            raise FileNotFoundError(f"Time series partition {condition_file} not found in {os.path.dirname(partition_dir)}")
+        partition_fields = set(file_fields(path))
+        partition = select_from_time_series(
+            path,
+            {param: value for param, value in (where or {}).items() if (param in partition_fields) or not (param in index_where)},
+            fields,
+            updates
+        )
+        run_count = len(partition["runs"]["SEED"])
+        for param in index_where:
+            if not param in partition_fields:
+                partition["runs"][param] = np.full(run_count, conditions[param][condition_i])
+        partitions.append(partition)
+    run_params = ["SEED"] + list(where or {})
+    if not len(partitions):
+        result = {"runs": {param: np.array([]) for param in run_params}, "updates": np.array([], dtype = np.int64)}
+        result.update({field: np.full((0, 0), np.nan) for field in fields})
+        return result
+    selected_updates = np.unique(np.concatenate([partition["updates"] for partition in partitions]))
+    result = {
+        "runs": {
+            param: np.concatenate([partition["runs"][param] for partition in partitions])
+            for param in run_params
+        },
+        "updates": selected_updates
+    }
+    run_counts = [len(partition["runs"]["SEED"]) for partition in partitions]
+    for field in fields:
+        table = np.full((sum(run_counts), len(selected_updates)), np.nan)
+        start = 0
+        for partition, run_count in zip(partitions, run_counts):
+            update_cols = np.searchsorted(selected_updates, partition["updates"])
+            table[start:start + run_count, update_cols] = partition[field]
+            start += run_count
+        result[field] = table
+    return result
+
+def select(experiment, where=None, fields=None, updates=None):
+    '''
+    Select time series fields for the runs of an experiment that match where.
+    - experiment: aggregation dump directory
+    - where: dictionary of run parameter: value (e.g., {"HEALTH_TYPE": "parasite"}); all runs if None
+    - fields: list of time series field names (as in time_series.csv, e.g., "OrgCounts_host_count")
+    - updates: range (or collection) of updates to keep; all sampled updates if None
+    Returns a dictionary with:
+    - runs: run table (dictionary of arrays, one entry per matching run)
+    - updates: selected updates
+    - one (runs x updates) array per field (NaN where a run has no value)
+    '''
+    fields = [] if fields is None else list(fields)
+    cube_dir = os.path.join(experiment, "cube")
+    if os.path.isfile(os.path.join(cube_dir, "cube.npy")):
+        return select_from_cube(cube_dir, where, fields, updates)
+    time_series_path = time_series_file(experiment)
+    if time_series_path is not None:
+        return select_from_time_series(time_series_path, where, fields, updates)
+    partition_dir = os.path.join(experiment, "time_series")
+    if os.path.isfile(os.path.join(partition_dir, "conditions.csv")):
+        return select_from_partitions(partition_dir, where, fields, updates)
+    raise FileNotFoundError(f"No aggregated data (cube/, time_series.csv/.feather/.parquet, or time_series/conditions.csv) in {experiment}")
+
+def clear_cache():
+    '''
+    Forget every cached column/cube.
+    '''
+    column_cache.clear()
+    load_cube.cache_clear()
@@ -0,0 +1,347 @@
+'''
+Sharded aggregation: split an experiment's run directories across the tasks of a SLURM array
+job, then merge the per-shard output files with a dependent (reduce) job.
+
+- Map: array task I runs an experiment's aggregate.py over shard I (of N contiguous blocks of
+  RUN_* directories; see aggregation.py --shard/--num_shards), dumping output files into
+  work_dir/shard_I. Run directories are listed once, when job scripts are generated, into
+  work_dir/run_list.csv (see aggregation.py --run_list), so every task splits up the same runs
+  even if run directories show up while the array job is running.
+- Reduce: once every map task succeeded, per-shard output files are concatenated in shard
+  order (see utils.merge_csv_files) into dump_dir, so rows come out in the same order as
+  aggregating every run at once. Shards count as finished only once their aggregation wrote its
+  completion marker (see aggregation.done_marker); otherwise, the reduce fails.
+
+Files merged: run_status.csv, summary.csv, symbiont_interaction_values.csv, task acquisition
+files, time_series.csv, and time series pyramid files (time_series_r*.csv). Output that is
+computed across runs (--rollup, --cube, --interaction_histograms, --partition_time_series) is
+not merged, so these aggregation arguments are rejected (as is --columnar_only, which would
+leave no csv files to merge); compute it from merged output (or aggregate without sharding).
+
+Usage (from this scripts directory):
+
+python sharding.py gen --aggregate_script <experiment>/analysis/aggregate.py --data_dir <data dir> --dump_dir <dump dir> --num_shards N [--recursive] [--aggregate_args="--summary_update 200000 ..."]
+  Writes aggregate-map.sb (array job), aggregate-reduce.sb, and submit.sh into job_dir.
+  Run submit.sh to submit both jobs (reduce depends on the whole map array; do not submit
+  these with sub-jobs.py, which would drop the dependency).
+python sharding.py local <same arguments as gen> [--parallel P]
+  Generates the same job scripts, then runs them on this machine in place of SLURM
+  (up to P map tasks at a time, then the reduce job).
+python sharding.py reduce --work_dir <work dir> --num_shards N --dump_dir <dump dir>
+  Merge shard output files (what the reduce job runs).
+'''
+
+import argparse
+import glob
+import os
+import shlex
+import subprocess
+import sys
+
+import aggregation
+import discovery
+import utilities as utils
+
+# Default configuration values
+default_job_time_request = "4:00:00"
+default_job_mem_request = "8G"
+
+# Output files merged across shards (in addition to time series pyramid files)
+merged_files = [
+    "run_status.csv",
+    "summary.csv",
+    "symbiont_interaction_values.csv",
+    "task_acquisition.csv",
+    "task_acquisition_long.csv",
+    "time_series.csv"
+]
+
+# Aggregation arguments that can't be passed through --aggregate_args (and why)
+rejected_aggregate_args = {
+    "--columnar_only": "shard csv files are needed for merging (columnar files are not merged)",
+    "--rollup": "computed across runs; not merged",
+    "--cube": "computed across runs; not merged",
+    "--interaction_histograms": "computed across runs; not merged",
+    "--partition_time_series": "partitioned time series files are not merged",
+    "--shard": "set for each map task",
+    "--num_shards": "set by sharding.py (use --num_shards)",
+    "--run_list": "set by sharding.py",
+    "--recursive": "run directories are listed by sharding.py (use --recursive)",
+    "--data_dir": "set by sharding.py (use --data_dir)",
+    "--dump_dir": "set for each map task"
+}
+
+map_slurm_script = '''#!/bin/bash --login
+########## Define Resources Needed with SBATCH Lines ##########
+
+#SBATCH --time=<<TIME_REQUEST>>          # limit of wall clock time - how long the job will run (same as -t)
+#SBATCH --array=0-<<LAST_SHARD>>
+#SBATCH --mem=<<MEMORY_REQUEST>>        # memory required per node - amount of memory (in bytes)
+#SBATCH --job-name <<JOB_NAME>>-map     # you can give your job a name for easier identification (same as -J)
+<<HPC_ACCOUNT_INFO>>
+
+########## Command Lines to Run ##########
+
+SHARD=${SLURM_ARRAY_TASK_ID}
+
+# Load correct environment variables, modules, etc.
+<<SETUP_HPC_ENV>>
+
+python3 <<AGGREGATE_SCRIPT>> \\
+  --data_dir <<DATA_DIR>> \\
+  --dump_dir <<WORK_DIR>>/shard_${SHARD} \\
+  --run_list <<RUN_LIST>> \\
+  --shard ${SHARD} \\
+  --num_shards <<NUM_SHARDS>> <<AGGREGATE_ARGS>>
+'''
+
+reduce_slurm_script = '''#!/bin/bash --login
+########## Define Resources Needed with SBATCH Lines ##########
+
+#SBATCH --time=<<TIME_REQUEST>>          # limit of wall clock time - how long the job will run (same as -t)
+#SBATCH --mem=<<MEMORY_REQUEST>>        # memory required per node - amount of memory (in bytes)
+#SBATCH --job-name <<JOB_NAME>>-reduce  # you can give your job a name for easier identification (same as -J)
+<<HPC_ACCOUNT_INFO>>
+
+########## Command Lines to Run ##########
+
+# Load correct environment variables, modules, etc.
+<<SETUP_HPC_ENV>>
+
+python3 <<SHARDING_SCRIPT>> reduce \\
+  --work_dir <<WORK_DIR>> \\
+  --num_shards <<NUM_SHARDS>> \\
+  --dump_dir <<DUMP_DIR>>
+'''
+
+submit_script = '''#!/bin/bash
+# Submit sharded aggregation: map array job, then reduce job once every map task succeeded.
+cd <<JOB_DIR>>
+MAP_JOB_ID=$(sbatch --parsable aggregate-map.sb)
+MAP_JOB_ID=${MAP_JOB_ID%%;*}
+echo "Submitted map array job ${MAP_JOB_ID}"
+sbatch --dependency=afterok:${MAP_JOB_ID} aggregate-reduce.sb
+'''
+
+def shard_dir(work_dir, shard):
+    return os.path.join(work_dir, f"shard_{shard}")
+
+def run_list_path(work_dir):
+    return os.path.join(work_dir, "run_list.csv")
+
+def check_aggregate_args(aggregate_args):
+    '''
+    Arguments (in aggregate_args) that can't be passed on to map tasks (see
+    rejected_aggregate_args), with the reason why. Abbreviated arguments (which argparse
+    accepts) are matched as well.
+    '''
+    rejected = []
+    for arg in shlex.split(aggregate_args):
+        if not arg.startswith("--"):
+            continue
+        name = arg.split("=", 1)[0]
+        for rejected_arg, reason in rejected_aggregate_args.items():
+            if rejected_arg.startswith(name):
+                rejected.append((arg, reason))
+                break
+    return rejected
+
+def join_aggregate_args(argv):
+    '''
+    Command line arguments with --aggregate_args VALUE joined into --aggregate_args=VALUE, so that
+    values starting with a dash (e.g., --aggregate_args "--streaming_join") are not taken for
+    options by argparse.
+    '''
+    joined = []
+    argv = list(argv)
+    while len(argv):
+        arg = argv.pop(0)
+        if (arg == "--aggregate_args") and len(argv):
+            arg = f"{arg}={argv.pop(0)}"
+        joined.append(arg)
+    return joined
+
+def fill_template(template, values):
+    for key, value in values.items():
+        template = template.replace(f"<<{key}>>", str(value))
+    return template
+
+def write_job_scripts(args):
+    '''
+    Write map/reduce job scripts and submit.sh into args.job_dir.
+    Returns (map script path, reduce script path).
+    '''
+    utils.mkdir_p(args.job_dir)
+    setup_env = []
+    if args.hpc_env_file is not None:
+        setup_env.append(f"source {args.hpc_env_file}")
+    if args.venv_dir is not None:
+        setup_env.append(f"source {os.path.join(args.venv_dir, 'bin', 'activate')}")
+    values = {
+        "TIME_REQUEST": args.time_request,
+        "MEMORY_REQUEST": args.mem,
+        "JOB_NAME": args.job_name,
+        "HPC_ACCOUNT_INFO": "" if args.hpc_account is None else f"#SBATCH --account {args.hpc_account}",
+        "SETUP_HPC_ENV": "\n".join(setup_env),
+        "LAST_SHARD": args.num_shards - 1,
+        "NUM_SHARDS": args.num_shards,
+        "AGGREGATE_SCRIPT": args.aggregate_script,
+        "AGGREGATE_ARGS": args.aggregate_args,
+        "SHARDING_SCRIPT": os.path.abspath(__file__),
+        "DATA_DIR": args.data_dir,
+        "WORK_DIR": args.work_dir,
+        "RUN_LIST": run_list_path(args.work_dir),
+        "DUMP_DIR": args.dump_dir,
+        "JOB_DIR": args.job_dir
+    }
+    map_path = os.path.join(args.job_dir, "aggregate-map.sb")
+    reduce_path = os.path.join(args.job_dir, "aggregate-reduce.sb")
+    submit_path = os.path.join(args.job_dir, "submit.sh")
+    for path, template in [(map_path, map_slurm_script), (reduce_path, reduce_slurm_script), (submit_path, submit_script)]:
+        with open(path, "w") as fp:
+            fp.write(fill_template(template, values))
+    os.chmod(submit_path, 0o755)
+    return map_path, reduce_path
+
+def run_local(map_path, reduce_path, num_shards, log_dir, parallel=1):
+    '''
+    Stand-in for SLURM: run every map (array) task, up to parallel at a time, with
+    SLURM_ARRAY_TASK_ID set, then the reduce job if every map task succeeded.
+    Each job's output goes to a log file in log_dir. Returns True if every job succeeded.
+    '''
+    utils.mkdir_p(log_dir)
+    pending = list(range(num_shards))
+    running = []
+    failed = []
+    while len(pending) or len(running):
+        while len(pending) and (len(running) < parallel):
+            shard = pending.pop(0)
+            log_fp = open(os.path.join(log_dir, f"map_{shard}.log"), "w")
+            task = subprocess.Popen(
+                ["bash", map_path],
+                env = dict(os.environ, SLURM_ARRAY_TASK_ID = str(shard)),
+                stdout = log_fp,
+                stderr = subprocess.STDOUT
+            )
+            running.append((shard, task, log_fp))
+        shard, task, log_fp = running.pop(0)
+        task.wait()
+        log_fp.close()
+        print(f"Map task {shard}: {'done' if task.returncode == 0 else 'FAILED'}")
+        if task.returncode != 0:
+            failed.append(shard)
+    if len(failed):
+        print(f"Map tasks failed (see {log_dir}): {','.join(map(str, sorted(failed)))}")
+        print("Not running reduce job.")
+        return False
+    with open(os.path.join(log_dir, "reduce.log"), "w") as log_fp:
+        reduced = subprocess.run(["bash", reduce_path], stdout = log_fp, stderr = subprocess.STDOUT)
+    print(f"Reduce job: {'done' if reduced.returncode == 0 else 'FAILED'}")
+    return reduced.returncode == 0
+
+def reduce_shards(work_dir, num_shards, dump_dir):
+    '''
+    Merge every shard's output files (see merged_files) into dump_dir, in shard order.
+    Exits if any shard's aggregation did not finish (no completion marker; see
+    aggregation.done_marker).
+    '''
+    shard_dirs = [shard_dir(work_dir, shard) for shard in range(num_shards)]
+    unfinished = [
+        str(shard) for shard in range(num_shards)
+        if not os.path.isfile(os.path.join(shard_dirs[shard], aggregation.done_marker))
+    ]
+    if len(unfinished):
+        print(f"Aggregation did not finish for shards: {','.join(unfinished)}")
+        exit(-1)
+    utils.mkdir_p(dump_dir)
+    pyramid_files = set()
+    for path in shard_dirs:
+        pyramid_files.update(os.path.basename(level_path) for level_path in glob.glob(os.path.join(path, "time_series_r*.csv")))
+    for file_name in merged_files + sorted(pyramid_files):
+        merged = utils.merge_csv_files(
+            [os.path.join(path, file_name) for path in shard_dirs],
+            os.path.join(dump_dir, file_name)
+        )
+        if merged:
+            print(f"Merged {file_name} ({merged} shards)")
+
+def add_job_arguments(parser):
+    parser.add_argument("--aggregate_script", type=str, help="Experiment aggregation script to run on each shard (analysis/aggregate.py)")
+    parser.add_argument("--aggregate_args", type=str, default="", help="Extra arguments passed on to the aggregation script (e.g., --aggregate_args=\"--summary_update 200000\")")
+    parser.add_argument("--data_dir", type=str, help="Where is the base output directory for each run?")
+    parser.add_argument("--dump_dir", type=str, help="Where to write merged output files?")
+    parser.add_argument("--num_shards", type=int, help="How many shards (array tasks) to split run directories into?")
+    parser.add_argument("--recursive", action="store_true", help="Look for run directories in sub-directories of data_dir (e.g., sharded layouts)")
+    parser.add_argument("--work_dir", type=str, default=None, help="Where to write per-shard output files? If none, use 'shards' inside of the dump_dir")
+    parser.add_argument("--job_dir", type=str, default=None, help="Where to output job files? If none, use 'jobs' inside of the work_dir")
+    parser.add_argument("--job_name", type=str, default="aggregate", help="Name prefix for map/reduce jobs")
+    parser.add_argument("--hpc_account", type=str, default=None, help="Value to use for the slurm ACCOUNT")
+    parser.add_argument("--time_request", type=str, default=default_job_time_request, help="How long to request for each job on hpc?")
+    parser.add_argument("--mem", type=str, default=default_job_mem_request, help="How much memory to request for each job?")
+    parser.add_argument("--hpc_env_file", type=str, default=None, help="Bash script that loads correct hpc modules")
+    parser.add_argument("--venv_dir", type=str, default=None, help="Python virtual environment to activate in each job")
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded aggregation (SLURM array map + reduce jobs).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_job_arguments(subparsers.add_parser("gen", help="Generate SLURM job scripts"))
+    local_parser = subparsers.add_parser("local", help="Generate job scripts, then run them on this machine")
+    add_job_arguments(local_parser)
+    local_parser.add_argument("--parallel", type=int, default=1, help="How many map tasks to run at a time?")
+    reduce_parser = subparsers.add_parser("reduce", help="Merge shard output files")
+    reduce_parser.add_argument("--work_dir", type=str, help="Where are per-shard output files?")
+    reduce_parser.add_argument("--num_shards", type=int, help="How many shards were run directories split into?")
+    reduce_parser.add_argument("--dump_dir", type=str, help="Where to write merged output files?")
+
+    args = parser.parse_args(join_aggregate_args(sys.argv[1:]))
+
+    if args.command == "reduce":
+        reduce_shards(args.work_dir, args.num_shards, args.dump_dir)
+        return
+
+    if (args.num_shards is None) or (args.num_shards < 1):
+        print("Must specify --num_shards (>= 1)")
+        exit(-1)
+    if not os.path.exists(args.aggregate_script):
+        print("Unable to find aggregation script.")
+        exit(-1)
+    if not os.path.exists(args.data_dir):
+        print("Unable to find data directory.")
+        exit(-1)
+    rejected = check_aggregate_args(args.aggregate_args)
+    if len(rejected):
+        for arg, reason in rejected:
+            print(f"Cannot pass {arg} through --aggregate_args: {reason}")
+        exit(-1)
+
+    # Jobs run from the job directory, so every path is made absolute
+    args.aggregate_script = os.path.abspath(args.aggregate_script)
+    args.data_dir = os.path.abspath(args.data_dir)
+    args.dump_dir = os.path.abspath(args.dump_dir)
+    if args.work_dir is None:
+        args.work_dir = os.path.join(args.dump_dir, "shards")
+    args.work_dir = os.path.abspath(args.work_dir)
+    if args.job_dir is None:
+        args.job_dir = os.path.join(args.work_dir, "jobs")
+    args.job_dir = os.path.abspath(args.job_dir)
+
+    # Freeze the list of runs that every map task splits up
+    utils.mkdir_p(args.work_dir)
+    run_dirs = discovery.find_run_dirs(args.data_dir, recursive = args.recursive)
+    discovery.write_run_list(run_list_path(args.work_dir), run_dirs)
+
+    map_path, reduce_path = write_job_scripts(args)
+    print(f"Generated {args.num_shards} map tasks + reduce job in {args.job_dir}")
+    print(f" - Run directories: {len(run_dirs)} (listed in {run_list_path(args.work_dir)})")
+    print(f" - Data directory: {args.data_dir}")
+    print(f" - Shard output directory: {args.work_dir}")
+    print(f" - Merged output directory: {args.dump_dir}")
+
+    if args.command == "local":
+        if not run_local(map_path, reduce_path, args.num_shards, os.path.join(args.job_dir, "logs"), args.parallel):
+            exit(-1)
+    else:
+        print(f"Submit with: {os.path.join(args.job_dir, 'submit.sh')}")
+
+if __name__ == "__main__":
+    main()
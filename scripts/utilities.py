@@ -1,6 +1,14 @@
+import array
 import csv
 import errno
+import hashlib
+import heapq
 import os
+import pickle
+import shutil
+import numpy as np
+
+import archives
 
 def mkdir_p(path):
     """
@@ -13,44 +21,754 @@ def mkdir_p(path):
             pass
         else: raise
 
-def read_csv(file_path):
+def iter_csv(file_path, fields=None):
+    """
+    Lazily read content of csv file, yielding one dictionary with header:value entries
+    per row. If fields is given, only those columns are kept in each yielded row.
+    Only a single row is held in memory at a time.
+    """
+    with archives.open_file(file_path, "r") as fp:
+        reader = csv.reader(
+            fp,
+            quotechar='"',
+            delimiter=',',
+            quoting=csv.QUOTE_ALL,
+            skipinitialspace=True
+        )
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [
+            (i, field) for i, field in enumerate(header)
+            if (fields is None) or (field in fields)
+        ]
+        for row in reader:
+            # Skip blank lines (e.g., trailing newlines at end of file) and partially
+            # written lines (e.g., the last line of a file from a killed job)
+            if len(row) < len(header):
+                continue
+            yield {field: row[i] for i, field in columns}
+
+def iter_csv_merged(file_paths, fields=None, key="update"):
+    """
+    Walk several csv files (each sorted by key, ascending) together in key order, as a
+    streaming k-way merge-join. Yields (key value, rows) where rows[i] is file i's row for
+    that key value (None if file i has no row for it, e.g., a file truncated by a killed job).
+    fields, if given, is a list with the fields to keep for each file.
+    At most one row per file is held in memory at a time.
+    """
+    def keyed_rows(file_i):
+        file_fields = None if fields is None else set(fields[file_i]) | {key}
+        for row in iter_csv(file_paths[file_i], file_fields):
+            yield int(row[key]), file_i, row
+
+    merged = heapq.merge(
+        *[keyed_rows(file_i) for file_i in range(len(file_paths))],
+        key = lambda item: (item[0], item[1])
+    )
+    current_key = None
+    rows = None
+    for row_key, file_i, row in merged:
+        if row_key != current_key:
+            if rows is not None:
+                yield current_key, rows
+            current_key = row_key
+            rows = [None for _ in file_paths]
+        rows[file_i] = row
+    if rows is not None:
+        yield current_key, rows
+
+def read_csv_header(file_path):
+    """
+    Read just the header (first line) of a csv file.
+    Returns None if the file does not exist or is empty.
+    """
+    if not archives.exists(file_path):
+        return None
+    with archives.open_file(file_path, "r") as fp:
+        reader = csv.reader(
+            fp,
+            quotechar='"',
+            delimiter=',',
+            quoting=csv.QUOTE_ALL,
+            skipinitialspace=True
+        )
+        return next(reader, None)
+
+def read_csv(file_path, fields=None):
     """
     Read content of csv file into a list where each entry in the list is a dictionary
     with header:value entries.
     """
-    content = None
-    with open(file_path, "r") as fp:
-        content = fp.read().strip().split("\n")
-    header = content[0].split(",")
-    content = content[1:]
-    lines = [
-        {header[i]: l[i] for i in range(len(header))}
-        for l in csv.reader(
-            content,
+    return list(iter_csv(file_path, fields))
+
+def typed_array(values, dtype=None):
+    """
+    Convert a list of strings into a typed numpy array.
+    If no dtype is given, use int64 if every value parses as an integer, float64 if
+    every value parses as a number, and fall back to strings otherwise.
+    """
+    values = np.array(values, dtype=str)
+    if dtype is not None:
+        return values.astype(dtype)
+    for candidate in (np.int64, np.float64):
+        try:
+            return values.astype(candidate)
+        except ValueError:
+            continue
+    return values
+
+def read_csv_columns(file_path, fields=None, dtypes=None, update_rows=None):
+    """
+    Read content of csv file into a dictionary that maps each column name to a typed
+    numpy array (see typed_array). If fields is given, only those columns are loaded.
+    dtypes optionally maps column names to a forced numpy dtype.
+    update_rows optionally maps updates to None; each is replaced by the full row (header:value
+    entries, as from read_csv_row) of the last row that matches the update (the last row for
+    None), taken from the same pass over the file. Updates no row matches stay None.
+    """
+    dtypes = {} if dtypes is None else dtypes
+    update_rows = {} if update_rows is None else update_rows
+    row_updates = {str(update): update for update in update_rows if update is not None}
+    with archives.open_file(file_path, "r") as fp:
+        reader = csv.reader(
+            fp,
             quotechar='"',
             delimiter=',',
             quoting=csv.QUOTE_ALL,
             skipinitialspace=True
         )
-    ]
-    return lines
+        header = next(reader, None)
+        if header is None:
+            return {}
+        columns = [
+            (i, field) for i, field in enumerate(header)
+            if (fields is None) or (field in fields)
+        ]
+        values = {field: [] for _, field in columns}
+        update_col = header.index("update") if "update" in header else None
+        last_row = None
+        for row in reader:
+            # Skip blank lines (e.g., trailing newlines at end of file) and partially
+            # written lines (e.g., the last line of a file from a killed job)
+            if len(row) < len(header):
+                continue
+            for i, field in columns:
+                values[field].append(row[i])
+            last_row = row
+            if (update_col is not None) and (row[update_col] in row_updates):
+                update_rows[row_updates[row[update_col]]] = dict(zip(header, row))
+        if (None in update_rows) and (last_row is not None):
+            update_rows[None] = dict(zip(header, last_row))
+    return {
+        field: typed_array(values[field], dtypes.get(field, None))
+        for field in values
+    }
+
+def iter_csv_column_chunks(file_path, fields=None, chunk_size=65536, dtypes=None):
+    """
+    Chunked version of read_csv_columns: lazily read content of csv file in chunks of (up to)
+    chunk_size rows, yielding one dictionary of typed numpy arrays (see typed_array) per chunk.
+    Only a single chunk is held in memory at a time.
+    """
+    dtypes = {} if dtypes is None else dtypes
+    values = None
+    for row in iter_csv(file_path, fields):
+        if values is None:
+            values = {field: [] for field in row}
+        for field in values:
+            values[field].append(row[field])
+        if len(values[field]) >= chunk_size:
+            yield {field: typed_array(values[field], dtypes.get(field, None)) for field in values}
+            values = {field: [] for field in values}
+    if (values is not None) and len(next(iter(values.values()), [])):
+        yield {field: typed_array(values[field], dtypes.get(field, None)) for field in values}
+
+# Version of the column cache layout (caches written with another version are rebuilt)
+columns_cache_format = 2
+
+def compact_column(values):
+    """
+    Column to store in the column cache for a text column: its typed version (see typed_array)
+    if that converts back to exactly the same text, else the text itself. Either way, the
+    cache can give back values as written in the csv file.
+    """
+    typed = typed_array(values)
+    if (typed.dtype.kind != "U") and np.array_equal(typed.astype(str), values):
+        return typed
+    return values
+
+def columns_cache_path(file_path, cache_dir=None):
+    """
+    Location of the binary column cache for the given csv file.
+    """
+    return sidecar_path(file_path, ".columns.npz", cache_dir)
+
+def read_csv_columns_cached(file_path, fields=None, dtypes=None, cache_dir=None, update_rows=None):
+    """
+    Cached version of read_csv_columns. The first time a file is read, all of its
+    columns are parsed and stored in a binary (.npz) cache next to the file (or in
+    cache_dir). Later reads load only the requested columns from the cache. The cache
+    is rebuilt whenever the file's size or modification time changes.
+    Columns whose typed values would not convert back to the text in the file (e.g., 17.50)
+    are cached as text, so that forcing a column to str gives back the values as written.
+    update_rows works as in read_csv_columns (rows are taken from every cached column).
+    """
+    update_rows = {} if update_rows is None else update_rows
+    cache_path = columns_cache_path(file_path, cache_dir)
+    stat = archives.stat(file_path)
+    columns = None
+    if os.path.isfile(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if (int(cache["__format__"]) == columns_cache_format) and (int(cache["__size__"]) == stat.st_size) and (int(cache["__mtime__"]) == stat.st_mtime_ns):
+                    columns = {
+                        field: cache[field]
+                        for field in cache["__columns__"].tolist()
+                        if (fields is None) or (field in fields)
+                    }
+                    if len(update_rows):
+                        fill_update_rows(cache, cache["__columns__"].tolist(), update_rows)
+        except (OSError, ValueError, KeyError):
+            columns = None
+    if columns is None:
+        header = read_csv_header(file_path) or []
+        data = read_csv_columns(file_path, dtypes={field: str for field in header})
+        data = {field: compact_column(data[field]) for field in data}
+        fill_update_rows(data, list(data.keys()), update_rows)
+        cache = {field: data[field] for field in data}
+        cache["__columns__"] = np.array(list(data.keys()), dtype=str)
+        cache["__format__"] = columns_cache_format
+        cache["__size__"] = stat.st_size
+        cache["__mtime__"] = stat.st_mtime_ns
+        save_npz(cache_path, cache)
+        columns = {
+            field: data[field]
+            for field in data
+            if (fields is None) or (field in fields)
+        }
+    dtypes = {} if dtypes is None else dtypes
+    for field in columns:
+        if field in dtypes:
+            columns[field] = columns[field].astype(dtypes[field])
+        elif columns[field].dtype.kind == "U":
+            columns[field] = typed_array(columns[field])
+    return columns
+
+def fill_update_rows(data, fields, update_rows):
+    """
+    Fill in update_rows (see read_csv_columns) from columnar data (e.g., a column cache) that
+    has the given fields. Values come back as text (columns must convert back to the text in the
+    file, see compact_column).
+    """
+    if not "update" in fields:
+        return
+    updates = {"update": typed_array(data["update"]) if data["update"].dtype.kind == "U" else data["update"]}
+    for update in update_rows:
+        row = find_update_row(updates, update)
+        if row is not None:
+            update_rows[update] = {field: str(data[field][row]) for field in fields}
+
+def find_update_row(data, target_update):
+    """
+    Given columnar data (see read_csv_columns), return the index of the last row
+    that matches target_update (or the last row if target_update is None).
+    Returns None if no row matches.
+    """
+    if not "update" in data:
+        return None
+    updates = data["update"]
+    if target_update is None:
+        return (len(updates) - 1) if len(updates) else None
+    rows = np.flatnonzero(updates == target_update)
+    return int(rows[-1]) if len(rows) else None
+
+def sidecar_path(file_path, suffix, cache_dir=None):
+    """
+    Location of a sidecar file (e.g., an index or cache) for the given file.
+    Sidecars live next to the file unless a cache directory is given, in which case
+    the sidecar name is made unique by hashing the file's absolute path.
+    """
+    if cache_dir is None:
+        return f"{file_path}{suffix}"
+    path_hash = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{path_hash}_{os.path.basename(file_path)}{suffix}")
+
+def save_npz(path, arrays):
+    """
+    Write arrays to an .npz file, replacing any existing file atomically.
+    Returns False (instead of raising) if the file could not be written.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, **arrays)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+# Version of the update index layout (indices written with another version are rebuilt)
+update_index_format = 2
+
+def update_index_path(file_path, cache_dir=None):
+    """
+    Location of the update index sidecar file for the given output file.
+    """
+    return sidecar_path(file_path, ".update_index.npz", cache_dir)
+
+def build_update_index(file_path):
+    """
+    Scan an output file once, recording the byte offset of each row keyed by the
+    row's update. Returns a dictionary with 'updates' and 'offsets' arrays (in file
+    order) along with the 'size' and 'mtime' of the file that was indexed.
+    Rows shorter than the header (e.g., the partially written last line of a file from
+    a killed job) are left out.
+    """
+    stat = archives.stat(file_path)
+    # (compact, typed buffers; files can have hundreds of thousands of rows)
+    updates = array.array("q")
+    offsets = array.array("q")
+    with archives.open_file(file_path, "rb") as fp:
+        header = fp.readline().decode().strip().split(",")
+        if "update" in header:
+            update_col = header.index("update")
+            offset = fp.tell()
+            for line in fp:
+                values = line.split(b",")
+                if len(values) >= len(header):
+                    try:
+                        updates.append(int(values[update_col]))
+                        offsets.append(offset)
+                    except ValueError:
+                        pass
+                offset += len(line)
+    return {
+        "updates": np.frombuffer(updates, dtype=np.int64).copy(),
+        "offsets": np.frombuffer(offsets, dtype=np.int64).copy(),
+        "format": update_index_format,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns
+    }
+
+def load_update_index(file_path, save=True, cache_dir=None):
+    """
+    Load the update index sidecar for the given output file, (re)building it if it
+    is missing or stale (i.e., the file's size or modification time changed).
+    If save is True, newly built indices are written out next to the file (or to
+    cache_dir, if given).
+    """
+    index_path = update_index_path(file_path, cache_dir)
+    stat = archives.stat(file_path)
+    if os.path.isfile(index_path):
+        try:
+            with np.load(index_path) as index_file:
+                index = {key: index_file[key] for key in index_file.files}
+            index["format"] = int(index["format"])
+            index["size"] = int(index["size"])
+            index["mtime"] = int(index["mtime"])
+            if (index["format"] == update_index_format) and (index["size"] == stat.st_size) and (index["mtime"] == stat.st_mtime_ns):
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+    index = build_update_index(file_path)
+    if save:
+        # If we can't write the index (e.g., read-only directory), just use it in memory.
+        save_npz(index_path, index)
+    return index
+
+def read_csv_row(file_path, target_update, index=None, cache_dir=None):
+    """
+    Read the row of an output file that matches target_update (last match wins;
+    last row if target_update is None) by seeking straight to it using the file's
+    update index. Returns a dictionary with header:value entries, or None if no
+    (complete) row matches.
+    """
+    index = load_update_index(file_path, cache_dir=cache_dir) if index is None else index
+    if target_update is None:
+        rows = np.arange(len(index["updates"]))
+    else:
+        rows = np.flatnonzero(index["updates"] == target_update)
+    if not len(rows):
+        return None
+    with archives.open_file(file_path, "rb") as fp:
+        header_line = fp.readline().decode()
+        fp.seek(int(index["offsets"][rows[-1]]))
+        line = fp.readline().decode()
+    header, values = csv.reader(
+        [header_line, line],
+        quotechar='"',
+        delimiter=',',
+        quoting=csv.QUOTE_ALL,
+        skipinitialspace=True
+    )
+    if len(values) < len(header):
+        return None
+    return {header[i]: values[i] for i in range(len(header))}
+
+def iter_lines_reversed(fp, start=0, block_size=65536):
+    """
+    Yield lines (as bytes, without line endings) of a binary file object from last to
+    first, reading backwards from the end of the file in blocks. Lines that begin
+    before the start byte offset are not yielded.
+    """
+    fp.seek(0, os.SEEK_END)
+    position = fp.tell()
+    remainder = b""
+    while position > start:
+        read_size = min(block_size, position - start)
+        position -= read_size
+        fp.seek(position)
+        lines = (fp.read(read_size) + remainder).split(b"\n")
+        # First piece might be a partial line; hold on to it until we read further back.
+        remainder = lines[0]
+        for line in reversed(lines[1:]):
+            yield line.rstrip(b"\r")
+    yield remainder.rstrip(b"\r")
+
+def read_csv_row_from_tail(file_path, target_update):
+    """
+    Read the row of an output file that matches target_update (last row if target_update
+    is None) by scanning backwards from the end of the file. Assumes rows are in
+    increasing update order, so the scan stops once it passes target_update.
+    Rows shorter than the header (e.g., a partially written last line) are skipped.
+    Returns a dictionary with header:value entries, or None if no row matches or the file
+    is compressed (reading it backwards would decompress it over and over; use read_csv_row).
+    """
+    if not archives.fast_seek(file_path):
+        return None
+    reader_args = dict(
+        quotechar='"',
+        delimiter=',',
+        quoting=csv.QUOTE_ALL,
+        skipinitialspace=True
+    )
+    with archives.open_file(file_path, "rb") as fp:
+        header = next(csv.reader([fp.readline().decode()], **reader_args), [])
+        if not "update" in header:
+            return None
+        update_col = header.index("update")
+        for line in iter_lines_reversed(fp, start=fp.tell()):
+            if len(line.split(b",")) < len(header):
+                continue
+            try:
+                line_update = int(line.split(b",")[update_col])
+            except ValueError:
+                continue
+            if (target_update is None) or (line_update == target_update):
+                values = next(csv.reader([line.decode()], **reader_args))
+                if len(values) < len(header):
+                    continue
+                return {header[i]: values[i] for i in range(len(header))}
+            if line_update < target_update:
+                return None
+    return None
+
+class CSVWriter:
+    """
+    Streams rows (dictionaries of header:value entries) out to a csv file through a
+    single, buffered file handle. Values are written (and quoted, if needed) through
+    the csv module. Field order is given by header or, if no header is given, by the
+    sorted fields of the first row written. Fields missing from a row are written as
+    missing_value; fields not in the header raise a ValueError.
+
+    With union_header, rows are spilled (pickled) to a temporary file next to the output
+    file instead, and the csv file is written on close with the union of every row's fields
+    as header (sorted, or in order of first appearance if sort_header is False), so rows
+    with fields the first row lacks are written in full.
+    """
+
+    def __init__(self, output_path, header=None, mode="w", write_header=True, buffer_size=1 << 20, missing_value="NA", union_header=False, sort_header=True):
+        self.output_path = output_path
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.writer = None
+        self.missing_value = missing_value
+        self.header = None
+        self.fields = None
+        self.write_header = write_header
+        self.sort_header = sort_header
+        self.spill_path = None
+        if union_header:
+            self.union = {} if header is None else dict.fromkeys(header)
+            self.spill_path = f"{output_path}.rows.tmp"
+            self.fp = open(self.spill_path, "wb", buffering=buffer_size)
+            return
+        self.open()
+        if header is not None:
+            self.set_header(header)
+
+    def open(self):
+        self.fp = open(self.output_path, self.mode, newline="", buffering=self.buffer_size)
+        self.writer = csv.writer(self.fp, lineterminator="\n")
+
+    def set_header(self, header):
+        self.header = list(header)
+        self.fields = set(self.header)
+        # An empty header (e.g., a union header when no rows were written) leaves the file empty
+        if self.write_header and len(self.header):
+            self.writer.writerow(self.header)
+
+    def write_row(self, row):
+        if self.spill_path is not None:
+            self.union.update(dict.fromkeys(row.keys()))
+            pickle.dump(row, self.fp, protocol=pickle.HIGHEST_PROTOCOL)
+            return
+        if self.header is None:
+            self.set_header(sorted(row.keys()))
+        elif not self.fields.issuperset(row.keys()):
+            unknown = sorted(set(row.keys()) - self.fields)
+            raise ValueError(f"Fields not in header of {self.output_path}: {', '.join(map(str, unknown))}")
+        self.writer.writerow([row.get(field, self.missing_value) for field in self.header])
+
+    def copy_rows(self, file_path, header=None):
+        """
+        Append the lines of a headerless csv file written with this writer's header (e.g., by
+        another process) as-is, without parsing them.
+        If the file was written with another header (given as header; e.g., a union header that
+        has since grown), its rows are instead re-mapped onto this writer's header: fields the
+        file lacks are written as missing_value, fields not in this writer's header are dropped.
+        """
+        with open(file_path, "r", newline="") as in_fp:
+            if (header is None) or (list(header) == self.header):
+                shutil.copyfileobj(in_fp, self.fp, 1 << 20)
+                return
+            for row in csv.reader(in_fp):
+                if not row:
+                    continue
+                self.write_row({
+                    field: value for field, value in zip(header, row)
+                    if field in self.fields
+                })
+
+    def write_rows(self, rows):
+        """
+        Write out rows from any iterable (e.g., a generator).
+        """
+        for row in rows:
+            self.write_row(row)
+
+    def close(self):
+        self.fp.close()
+        if self.spill_path is None:
+            return
+        # Write out spilled rows under the union header
+        spill_path = self.spill_path
+        self.spill_path = None
+        self.open()
+        self.set_header(sorted(self.union) if self.sort_header else list(self.union))
+        with open(spill_path, "rb") as spill_fp:
+            while True:
+                try:
+                    row = pickle.load(spill_fp)
+                except EOFError:
+                    break
+                self.write_row(row)
+        self.fp.close()
+        os.remove(spill_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def merge_csv_files(file_paths, output_path, missing_value="NA"):
+    """
+    Concatenate csv files (in order) into a single csv file. Missing and empty files are
+    skipped. If every file has the same header, data lines are copied over as-is. Otherwise,
+    the header is the union of every file's fields (sorted if every file's header is sorted,
+    else in order of first appearance), and fields a file is missing are written as missing_value.
+    Returns how many files were merged.
+    """
+    headers = {}
+    for file_path in file_paths:
+        header = read_csv_header(file_path)
+        if header is not None:
+            headers[file_path] = header
+    file_paths = [file_path for file_path in file_paths if file_path in headers]
+    if not len(file_paths):
+        return 0
+    first_header = headers[file_paths[0]]
+    if all(headers[file_path] == first_header for file_path in file_paths):
+        with open(output_path, "wb") as out_fp:
+            for file_i, file_path in enumerate(file_paths):
+                with archives.open_file(file_path, "rb") as in_fp:
+                    header_line = in_fp.readline()
+                    if file_i == 0:
+                        out_fp.write(header_line)
+                    shutil.copyfileobj(in_fp, out_fp, 1 << 20)
+        return len(file_paths)
+    merged_header = []
+    for file_path in file_paths:
+        merged_header += [field for field in headers[file_path] if not field in merged_header]
+    if all(headers[file_path] == sorted(headers[file_path]) for file_path in file_paths):
+        merged_header.sort()
+    with CSVWriter(output_path, header=merged_header, missing_value=missing_value) as writer:
+        for file_path in file_paths:
+            writer.write_rows(iter_csv(file_path))
+    return len(file_paths)
 
 def append_csv(output_path, out_lines, field_order):
-    lines = []
-    for info in out_lines:
-        line = ",".join([str(info[field]) for field in field_order])
-        lines.append(line)
-    out_content = "\n" + "\n".join(lines)
-    with open(output_path, "a") as fp:
-        fp.write(out_content)
-
-def write_csv(output_path:str, rows:list):
-    header = list(rows[0].keys())
-    header.sort()
-    lines = [ ",".join([str(row[field]) for field in header]) for row in rows ]
-    with open(output_path, "w") as fp:
-        fp.write(",".join(header) + "\n")
-        fp.write("\n".join(lines))
+    with CSVWriter(output_path, header=field_order, mode="a", write_header=False) as writer:
+        writer.write_rows(out_lines)
+
+def write_csv(output_path:str, rows):
+    with CSVWriter(output_path) as writer:
+        writer.write_rows(rows)
+
+# Values treated as missing when typing csv columns
+missing_values = {"", "NA"}
+
+def iter_csv_chunks(file_path, chunk_size=65536):
+    """
+    Lazily read content of csv file in chunks of (up to) chunk_size rows.
+    Yields (header, columns) where columns maps each field to a list of (string) values.
+    """
+    with archives.open_file(file_path, "r") as fp:
+        reader = csv.reader(fp)
+        header = next(reader, None)
+        # No header, or an empty header line (no fields)
+        if not header:
+            return
+        columns = [[] for _ in header]
+        for row in reader:
+            if not row:
+                continue
+            for i in range(len(header)):
+                columns[i].append(row[i])
+            if len(columns[0]) >= chunk_size:
+                yield header, dict(zip(header, columns))
+                columns = [[] for _ in header]
+        if len(columns[0]):
+            yield header, dict(zip(header, columns))
+
+def column_type(values):
+    """
+    Narrowest type ("int", "float", "bool", or "str") that fits every non-missing value
+    in the given list of strings. Returns None if all values are missing.
+    """
+    values = np.array([value for value in values if not value in missing_values], dtype=str)
+    if not len(values):
+        return None
+    for name, dtype in (("int", np.int64), ("float", np.float64)):
+        try:
+            values.astype(dtype)
+            return name
+        except ValueError:
+            continue
+    if set(np.unique(values).tolist()) <= {"True", "False"}:
+        return "bool"
+    return "str"
+
+def merge_column_types(type_a, type_b):
+    """
+    Narrowest type that fits values of both given column types (see column_type).
+    """
+    if (type_a is None) or (type_a == type_b):
+        return type_b
+    if type_b is None:
+        return type_a
+    if {type_a, type_b} == {"int", "float"}:
+        return "float"
+    return "str"
+
+def write_columnar(csv_path, output_path, file_format="feather", chunk_size=65536):
+    """
+    Convert a csv file into a typed, compressed columnar file (Arrow IPC/Feather or
+    Parquet) that R can read natively (arrow::read_feather, arrow::read_parquet).
+    Column types are determined up front by scanning the whole csv file, so every
+    column gets a single explicit type (int64, float64, bool, or string); missing
+    values become nulls. The csv file is converted in chunks to bound memory use.
+    A csv file without fields (or rows) gives a columnar file with no columns (or rows).
+    Requires pyarrow.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Writing feather/parquet output requires pyarrow (pip install pyarrow).")
+        raise
+    arrow_types = {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "str": pa.string(),
+        None: pa.string()
+    }
+    # Pass 1: figure out column types
+    header = read_csv_header(csv_path) or []
+    types = {field: None for field in header}
+    for _, columns in iter_csv_chunks(csv_path, chunk_size):
+        for field in header:
+            types[field] = merge_column_types(types[field], column_type(columns[field]))
+    schema = pa.schema([(field, arrow_types[types[field]]) for field in header])
+
+    # Pass 2: convert csv content chunk-by-chunk
+    if file_format == "feather":
+        writer = pa.ipc.new_file(
+            output_path,
+            schema,
+            options = pa.ipc.IpcWriteOptions(compression="zstd")
+        )
+    elif file_format == "parquet":
+        writer = pq.ParquetWriter(output_path, schema, compression="zstd")
+    else:
+        raise ValueError(f"Unknown columnar file format: {file_format}")
+    for _, columns in iter_csv_chunks(csv_path, chunk_size):
+        arrays = []
+        for field in header:
+            values = np.array(columns[field], dtype=str)
+            missing = np.isin(values, list(missing_values))
+            if types[field] in ("int", "float"):
+                values = np.where(missing, "0", values).astype(np.int64 if types[field] == "int" else np.float64)
+            elif types[field] == "bool":
+                values = values == "True"
+            arrays.append(pa.array(values, mask=missing, type=schema.field(field).type))
+        writer.write_batch(pa.record_batch(arrays, schema=schema))
+    writer.close()
+
+def replicate_stats(values, bootstrap_samples=1000, ci=0.95, rng=None):
+    """
+    Column-wise summary statistics over replicates.
+    values is a (replicates x points) array; missing values are NaN.
+    Returns a dictionary of arrays (one value per point): n, mean, sd, se, ci_low, ci_high.
+    Confidence intervals are percentile bootstrap intervals of the mean. All bootstrap
+    resamples are drawn at once as replicate count weights (bootstrap_samples x replicates),
+    so resampled means for every point come from a single matrix product.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    n = present.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=0) / n
+        sq_dev = np.where(present, (values - mean) ** 2, 0.0).sum(axis=0)
+        sd = np.where(n > 1, np.sqrt(sq_dev / np.maximum(n - 1, 1)), np.nan)
+        se = sd / np.sqrt(n)
+        ci_low = np.full(values.shape[1], np.nan)
+        ci_high = np.full(values.shape[1], np.nan)
+        if bootstrap_samples > 0 and values.shape[0] > 0:
+            rng = np.random.default_rng(0) if rng is None else rng
+            replicates = values.shape[0]
+            weights = rng.multinomial(
+                replicates,
+                np.full(replicates, 1.0 / replicates),
+                size=bootstrap_samples
+            ).astype(np.float64)
+            boot_means = (weights @ filled) / (weights @ present)
+            alpha = (1.0 - ci) / 2.0
+            points = n > 0
+            if np.any(points):
+                # Resamples that happen to miss every present replicate of a point are NaN (ignored)
+                ci_low[points], ci_high[points] = np.nanquantile(
+                    boot_means[:, points],
+                    [alpha, 1.0 - alpha],
+                    axis=0
+                )
+    return {"n": n, "mean": mean, "sd": sd, "se": se, "ci_low": ci_low, "ci_high": ci_high}
 
 def nearest(target:int, updates:list):
     return min(updates, key = lambda x:abs(target - x))
@@ -67,24 +785,26 @@ def filter_time_points_total(all_points, total):
     '''
     Given a sequence of points,
     sort points and sample 'total' amount of them, evenly distributed.
+    Returns sampled points as a numpy array.
     '''
-    sorted_points = sorted(all_points)
-    ids = { i * ((len(all_points) - 1) // (total - 1)) for i in range(total)}
+    sorted_points = np.sort(np.asarray(all_points))
+    ids = np.unique(np.arange(total) * ((len(sorted_points) - 1) // (total - 1)))
 
-    ids = sorted(list(ids))
     # If last id isn't final index, make it so.
     if ids[-1] != (len(sorted_points) - 1):
         ids[-1] = len(sorted_points) - 1
 
-    return [sorted_points[idx] for idx in ids]
+    return sorted_points[ids]
 
 def filter_time_points_interval(all_points, interval, guarantee_final_point=True):
     '''
     Given a sequence of points, sample sorted sequence at given interval.
     Guarant
+    Returns sampled points as a numpy array.
     '''
-    sorted_points = sorted(all_points)
-    return [
-        sorted_points[i] for i in range(len(sorted_points))
-        if (i == 0) or (not (i % interval)) or (guarantee_final_point and (i == (len(sorted_points) - 1)))
-    ]
\ No newline at end of file
+    sorted_points = np.sort(np.asarray(all_points))
+    ids = np.arange(len(sorted_points))
+    keep = (ids % interval) == 0
+    if guarantee_final_point and len(keep):
+        keep[-1] = True
+    return sorted_points[keep]
\ No newline at end of file